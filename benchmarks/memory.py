@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the memory used by each idle websocket connection (protocol object,
+mease state and factory indexes), before and after compact connection state
+
+    python -m benchmarks.memory
+"""
+from __future__ import print_function
+import gc
+import tracemalloc
+from uuid import uuid1
+
+from mease.registry import Mease
+from mease.backends.test import TestBackend
+from mease.fake import FakeClient
+from mease.server import MeaseWebSocketServerProtocol
+
+CONNECTIONS = 20000
+
+
+class Factory(object):
+    def __init__(self, mease):
+        self.mease = mease
+        self.clients_list = set()
+        self.clients = {}
+
+    def add_client(self, client):
+        self.clients_list.add(client)
+        self.clients[client._client_id] = client
+
+
+class EagerProtocol(MeaseWebSocketServerProtocol):
+    """
+    Previous connection state, with storage dicts and a string uuid
+    """
+    def onConnect(self, request):
+        self.storage = {}
+        self._client_id = str(uuid1())
+        self._sent_storage = {}
+
+
+class EagerFakeClient(object):
+    """
+    Previous remote client, without slots
+    """
+    def __init__(self, storage, factory):
+        self.storage = storage
+        self.factory = factory
+
+
+def measure(create):
+    """
+    Returns allocated bytes per object created by `create`
+    """
+    gc.collect()
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [create() for _ in range(CONNECTIONS)]
+    after = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    del objects
+
+    return (after - before) / float(CONNECTIONS)
+
+
+def connect(protocol_class, factory):
+    protocol = protocol_class()
+    protocol.factory = factory
+    protocol.peer = 'tcp:127.0.0.1:54321'
+    protocol.onConnect(None)
+    factory.add_client(protocol)
+    return protocol
+
+
+def main():
+    mease = Mease(TestBackend)
+
+    eager_factory = Factory(mease)
+    factory = Factory(mease)
+
+    cases = (
+        ('idle connection',
+         lambda: connect(EagerProtocol, eager_factory),
+         lambda: connect(MeaseWebSocketServerProtocol, factory)),
+        ('remote client',
+         lambda: EagerFakeClient({}, None),
+         lambda: FakeClient({}, None)),
+    )
+
+    print("{0:<18} {1:>14} {2:>14}".format('', 'before (bytes)', 'after (bytes)'))
+
+    for name, before, after in cases:
+        print("{0:<18} {1:>14.0f} {2:>14.0f}".format(
+            name, measure(before), measure(after)))
+
+
+if __name__ == '__main__':
+    main()
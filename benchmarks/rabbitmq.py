@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Compares RabbitMQ subscriber throughput with per-message acks, batched acks
+and no acks
+
+    python -m benchmarks.rabbitmq [broker_url]
+
+Defaults to kombu in-memory transport, which doesn't implement prefetch
+with multiple acks : use a local RabbitMQ broker url for realistic numbers
+"""
+from __future__ import print_function
+import sys
+import time
+from threading import Event
+
+from mease.registry import Mease
+from mease.executors import InlineExecutor
+from mease.backends.rabbitmq import RabbitMQBackend
+
+MODES = (
+    ('ack each', {'PREFETCH_COUNT': 100}),
+    ('batch ack', {'PREFETCH_COUNT': 1000, 'ACK_BATCH_SIZE': 100}),
+    ('no ack', {'PREFETCH_COUNT': 1000, 'NO_ACK': True}),
+)
+
+NUMBER = 20000
+
+
+class BenchmarkFactory(object):
+    def __init__(self, mease):
+        self.mease = mease
+        self.clients_list = set()
+
+    def get_client(self, client_id):
+        return None
+
+
+def run(broker_url, name, settings):
+    settings = dict(
+        settings, BROKER_URL=broker_url,
+        EXCHANGE='mease_benchmark_{name}'.format(name=name.replace(' ', '_')))
+
+    if broker_url.startswith('memory'):
+        settings.pop('PREFETCH_COUNT')
+
+    mease = Mease(RabbitMQBackend, settings, executor=InlineExecutor())
+
+    received = [0]
+    done = Event()
+
+    def counter(routing, clients_list, *args, **kwargs):
+        received[0] += 1
+        if received[0] == NUMBER:
+            done.set()
+
+    mease.sender(counter)
+
+    mease.subscriber.factory = BenchmarkFactory(mease)
+    mease.subscriber.connect()
+
+    start = time.time()
+
+    for i in range(NUMBER):
+        mease.publish(routing='benchmark', i=i)
+
+    done.wait(60)
+    elapsed = time.time() - start
+
+    print("{0:<12} {1:>10} {2:>12.0f}".format(name, received[0], received[0] / elapsed))
+
+
+def main():
+    broker_url = sys.argv[1] if len(sys.argv) > 1 else 'memory://'
+
+    print("Broker : {broker_url}".format(broker_url=broker_url))
+    print("{0:<12} {1:>10} {2:>12}".format('mode', 'messages', 'messages/s'))
+
+    for name, settings in MODES:
+        run(broker_url, name, settings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-message cost of receivers dispatch for plain-text and JSON traffic
+
+    python -m benchmarks.receivers
+"""
+from __future__ import print_function
+import json
+from timeit import timeit
+
+from mease.registry import Mease
+from mease.backends.test import TestBackend
+from mease.serializers import fast_json_loads
+
+MESSAGES = (
+    ('plain text', 'Hello world !'),
+    ('json', '{"type": "chat", "room": "lobby", "text": "Hello world !"}'),
+)
+
+NUMBER = 100000
+
+
+def receiver(client, clients_list, message):
+    pass
+
+
+def eager_call_receivers(mease, client, clients_list, message):
+    """
+    Previous receivers dispatch, parsing JSON for every message
+    Callbacks are run with `Mease.call` like the current dispatch
+    """
+    try:
+        json_message = json.loads(message)
+    except ValueError:
+        json_message = None
+
+    for func, to_json in mease.receivers:
+        if to_json:
+            if json_message is None:
+                continue
+            msg = json_message
+        else:
+            msg = message
+
+        mease.call(func, client, clients_list, msg)
+
+
+def main():
+    raw = Mease(TestBackend)
+    raw.receiver(receiver)
+
+    mixed = Mease(TestBackend)
+    mixed.receiver(receiver)
+    mixed.receiver(receiver, json=True)
+    mixed.receiver(receiver, json=True)
+
+    print("JSON decoder : {module}".format(
+        module=getattr(fast_json_loads, '__module__', 'json')))
+    print("{0:<12} {1:<10} {2:>12} {3:>12}".format(
+        'message', 'receivers', 'eager (us)', 'lazy (us)'))
+
+    for message_name, message in MESSAGES:
+        for receivers_name, mease in (('raw', raw), ('raw+json', mixed)):
+            eager = timeit(
+                lambda: eager_call_receivers(mease, None, [], message), number=NUMBER)
+            lazy = timeit(
+                lambda: mease.call_receivers(None, [], message), number=NUMBER)
+
+            print("{0:<12} {1:<10} {2:>12.2f} {3:>12.2f}".format(
+                message_name, receivers_name,
+                eager / NUMBER * 1e6, lazy / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
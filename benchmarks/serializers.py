@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compares pack/unpack cost and message size of mease serializers
+
+    python -m benchmarks.serializers
+"""
+from __future__ import print_function
+from timeit import timeit
+
+from mease.messages import ON_RECEIVE
+from mease.messages import ON_SEND
+from mease.serializers import Envelope
+from mease.serializers import SerializationError
+
+PAYLOADS = (
+    ('receive', (
+        ON_RECEIVE, '0c2c4f7e-1d4a-11e4-8c21-0800200c9a66',
+        {'uuid': '4f1b2c3d', 'user_id': 42, 'rooms': ['lobby', 'news']},
+        (), {'message': '{"type": "chat", "text": "Hello world !"}'})),
+    ('send', (
+        ON_SEND, None, None,
+        ('Hello', 'World'), {'routing': 'mease.demo', 'count': 3})),
+    ('large storage', (
+        ON_RECEIVE, '0c2c4f7e-1d4a-11e4-8c21-0800200c9a66',
+        dict(('key_{0}'.format(i), 'value_{0}'.format(i)) for i in range(200)),
+        (), {'message': 'ping'})),
+)
+
+NUMBER = 20000
+
+
+def main():
+    print("{0:<15} {1:<10} {2:>8} {3:>12} {4:>12}".format(
+        'payload', 'serializer', 'bytes', 'pack (us)', 'unpack (us)'))
+
+    for payload_name, payload in PAYLOADS:
+        for serializer in ('legacy', 'pickle', 'json', 'msgpack'):
+            try:
+                envelope = Envelope(serializer=serializer)
+            except SerializationError:
+                continue
+
+            packed = envelope.pack(payload)
+
+            pack = timeit(lambda: envelope.pack(payload), number=NUMBER)
+            unpack = timeit(lambda: envelope.unpack(packed), number=NUMBER)
+
+            print("{0:<15} {1:<10} {2:>8} {3:>12.2f} {4:>12.2f}".format(
+                payload_name, serializer, len(packed),
+                pack / NUMBER * 1e6, unpack / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
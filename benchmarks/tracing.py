@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-frame CPU cost of hot-path logging when DEBUG is disabled,
+before (messages always formatted) and after (messages only formatted when logged)
+
+    python -m benchmarks.tracing
+"""
+from __future__ import print_function
+import logging
+from timeit import timeit
+
+from mease import logger
+from mease.registry import Mease
+from mease.executors import InlineExecutor
+from mease.backends.test import TestBackend
+from mease.backends.test import TestSubscriber
+from mease.messages import ON_RECEIVE
+from mease.messages import MESSAGES_TYPES
+from mease.tracing import MessageTracer
+
+NUMBER = 100000
+
+PEER = 'tcp:127.0.0.1:54321'
+PAYLOAD = '{"type": "chat", "room": "lobby", "text": "Hello world !"}'
+STORAGE = {'user_id': 42, 'username': 'florian', 'rooms': ['lobby', 'random']}
+
+
+class Factory(object):
+    def __init__(self, mease):
+        self.mease = mease
+        self.clients_list = set()
+
+    def get_client(self, client_id):
+        return None
+
+
+class EagerSubscriber(TestSubscriber):
+    """
+    Previous dispatch, formatting the debug message for every message
+    """
+    def dispatch_message(self, message_type, client_id, client_storage, args, kwargs):
+        logger.debug("Backend message ({message_type}) : {args} {kwargs}".format(
+            message_type=dict(MESSAGES_TYPES)[message_type], args=args, kwargs=kwargs))
+
+        super(EagerSubscriber, self).dispatch_message(
+            message_type, client_id, client_storage, args, kwargs)
+
+
+def eager_on_message():
+    """
+    Previous incoming frame logging
+    """
+    logger.debug("Incoming message ({peer}) : {message}".format(
+        peer=PEER, message=PAYLOAD))
+
+
+def sampled_on_message(tracer):
+    """
+    Current incoming frame logging
+    """
+    log = tracer.sample()
+    if log is not None:
+        log("Incoming message ({peer}) : {message}".format(
+            peer=PEER, message=PAYLOAD))
+
+
+def dispatch(subscriber):
+    subscriber.dispatch_message(
+        ON_RECEIVE, 'client', dict(STORAGE), (), {'message': PAYLOAD})
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    mease = Mease(TestBackend, executor=InlineExecutor())
+    factory = Factory(mease)
+
+    eager_subscriber = EagerSubscriber()
+    eager_subscriber.factory = factory
+
+    subscriber = TestSubscriber()
+    subscriber.factory = factory
+
+    cases = (
+        ('onMessage', lambda: eager_on_message(),
+         lambda: sampled_on_message(mease.tracer)),
+        ('dispatch_message', lambda: dispatch(eager_subscriber),
+         lambda: dispatch(subscriber)),
+    )
+
+    print("{0:<18} {1:>12} {2:>12}".format('frame', 'before (us)', 'after (us)'))
+
+    for name, before, after in cases:
+        before_time = timeit(before, number=NUMBER)
+        after_time = timeit(after, number=NUMBER)
+
+        print("{0:<18} {1:>12.2f} {2:>12.2f}".format(
+            name, before_time / NUMBER * 1e6, after_time / NUMBER * 1e6))
+
+    # Sampled tracing overhead
+    mease.tracer = MessageTracer(rate=1000)
+    logging.getLogger('mease.trace').setLevel(logging.CRITICAL)
+
+    sampled_time = timeit(lambda: dispatch(subscriber), number=NUMBER)
+    print("{0:<18} {1:>12} {2:>12.2f}".format(
+        'dispatch (1/1000)', '', sampled_time / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
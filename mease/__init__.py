@@ -1,7 +1,7 @@
 import logging
 
+logger = logging.getLogger(__name__)
+
 from .registry import Mease
 
 __all__ = ('Mease', 'logger')
-
-logger = logging.getLogger(__name__)
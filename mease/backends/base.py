@@ -1,24 +1,53 @@
 # -*- coding: utf-8 -*-
-import pickle
+from collections import OrderedDict
+from time import time
+from uuid import uuid4
 from twisted.internet import reactor
 
 from .. import logger
 from ..fake import FakeClient
+from ..serializers import Envelope
+from ..serializers import SerializationError
 from ..messages import ON_OPEN
 from ..messages import ON_CLOSE
 from ..messages import ON_RECEIVE
 from ..messages import ON_SEND
-from ..messages import MESSAGES_TYPES
+from ..messages import ON_CLIENT_SEND
+from ..messages import MESSAGES_NAMES
 
-__all__ = ('BasePublisher', 'BaseSubscriber', 'BaseBackend')
+__all__ = (
+    'NODE_KEY', 'PublisherOverflow', 'PublisherDisconnected', 'BasePublisher', 'BaseSubscriber',
+    'BaseBackend')
+
+
+# Reserved message kwarg holding the node a message is sent to
+NODE_KEY = '_node'
+
+
+class PublisherOverflow(Exception):
+    """
+    Raised when a message can't be queued by a publisher
+    """
+    pass
+
+
+class PublisherDisconnected(Exception):
+    """
+    Raised when a publisher isn't connected to its broker
+    """
+    pass
 
 
 class BasePublisher(object):
     """
     Base publisher that handles outgoing messages
     """
-    def __init__(self, *args, **kwargs):
-        reactor.addSystemEventTrigger('before', 'shutdown', self.exit)
+    def __init__(self, envelope=None, node_id=None, timestamps=False, *args, **kwargs):
+        self.envelope = envelope or Envelope()
+        self.node_id = node_id
+        self.timestamps = timestamps
+        self.shutdown_trigger = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.exit)
 
     def connect(self):
         """
@@ -34,12 +63,28 @@ class BasePublisher(object):
         raise NotImplementedError(
             "You need to implement the `publish` method for your publisher")
 
+    def flush(self):
+        """
+        Publishes messages that may be buffered by the publisher
+        """
+        pass
+
+    def get_connection_errors(self):
+        """
+        Returns exceptions raised when the broker is unreachable
+        """
+        return (PublisherDisconnected,)
+
     def pack(self, message_type, client_id, client_storage, args, kwargs):
         """
         Packs a message
+        Messages are stamped with their publishing time when `timestamps` is True
         """
-        return pickle.dumps(
-            (message_type, client_id, client_storage, args, kwargs), protocol=2)
+        if self.timestamps:
+            kwargs = dict(kwargs, published_at=time())
+
+        return self.envelope.pack(
+            (message_type, client_id, client_storage, args, kwargs))
 
     def exit(self):
         """
@@ -52,9 +97,16 @@ class BaseSubscriber(object):
     """
     Base subscriber class that handles incoming messages
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, envelope=None, node_id=None, storages_size=10000, *args, **kwargs):
+        self.envelope = envelope or Envelope()
+        self.node_id = node_id
         reactor.addSystemEventTrigger('before', 'shutdown', self.exit)
 
+        # Storage of the `storages_size` last active remote clients
+        # when their changes are published as deltas
+        self.storages = OrderedDict()
+        self.storages_size = storages_size
+
     def connect(self):
         """
         Connects to the subscriber
@@ -62,38 +114,87 @@ class BaseSubscriber(object):
         raise NotImplementedError(
             "You need to implement the `connect` method for your subscriber")
 
+    def get_send_routings(self):
+        """
+        Returns routing keys of registered senders, or None if
+        some senders need every routing key
+        """
+        mease = self.factory.mease
+
+        if mease.global_senders or mease.regex_senders:
+            return None
+
+        return sorted(mease.routes)
+
     def unpack(self, message):
         """
         Unpacks a message
         """
-        return pickle.loads(message)
+        return self.envelope.unpack(message)
+
+    def handle_message(self, message):
+        """
+        Unpacks and dispatches a message
+        """
+        try:
+            message_type, client_id, client_storage, args, kwargs = self.unpack(message)
+        except SerializationError as e:
+            logger.warning("Rejected backend message : {error}".format(error=e))
+            return
+
+        # Message types added by newer mease versions are ignored
+        if message_type not in MESSAGES_NAMES:
+            logger.warning("Rejected backend message : unknown type {message_type}".format(
+                message_type=message_type))
+            return
+
+        self.dispatch_message(message_type, client_id, client_storage, args, kwargs)
 
     def dispatch_message(self, message_type, client_id, client_storage, args, kwargs):
         """
         Calls callback functions
         """
-        logger.debug("Backend message ({message_type}) : {args} {kwargs}".format(
-            message_type=dict(MESSAGES_TYPES)[message_type], args=args, kwargs=kwargs))
+        metrics = self.factory.mease.metrics
+        published_at = kwargs.pop('published_at', None)
+
+        if metrics.enabled:
+            metrics.received.inc(labels=(MESSAGES_NAMES[message_type],))
+
+            if published_at is not None:
+                metrics.round_trip.observe(time() - published_at)
+
+        log = self.factory.mease.tracer.sample()
+        if log is not None:
+            log("Backend message ({message_type}) : {args} {kwargs}".format(
+                message_type=MESSAGES_NAMES[message_type], args=args, kwargs=kwargs))
 
         if message_type in [ON_OPEN, ON_CLOSE, ON_RECEIVE]:
             # Find if client exists in clients_list
-            client = next(
-                (c for c in self.factory.clients_list if c._client_id == client_id), None)
+            client = self.factory.get_client(client_id)
+
+            storage_delta = kwargs.pop('storage_delta', None)
 
             # Create a fake client if it doesn't exists
             if not client:
+                if client_storage is None:
+                    client_storage = self.get_remote_storage(
+                        message_type, client_id, storage_delta)
+
                 client = FakeClient(storage=client_storage, factory=self.factory)
 
         if message_type == ON_OPEN:
-            reactor.callInThread(
+            self.factory.mease.executor.submit_to(
+                client_id,
                 self.factory.mease.call_openers, client, self.factory.clients_list)
 
         elif message_type == ON_CLOSE:
-            reactor.callInThread(
+            self.factory.mease.executor.submit_to(
+                client_id,
                 self.factory.mease.call_closers, client, self.factory.clients_list)
 
         elif message_type == ON_RECEIVE:
-            reactor.callInThread(
+            self.factory.mease.executor.submit_to(
+                client_id,
                 self.factory.mease.call_receivers,
                 client,
                 self.factory.clients_list,
@@ -102,13 +203,45 @@ class BaseSubscriber(object):
         elif message_type == ON_SEND:
             routing = kwargs.pop('routing')
 
-            reactor.callInThread(
+            self.factory.mease.executor.submit_to(
+                routing,
                 self.factory.mease.call_senders,
                 routing,
                 self.factory.clients_list,
                 *args,
                 **kwargs)
 
+        elif message_type == ON_CLIENT_SEND:
+            client = self.factory.get_client(client_id)
+
+            if client is not None:
+                client.send(kwargs['payload'])
+
+    def get_remote_storage(self, message_type, client_id, storage_delta):
+        """
+        Applies a storage delta to the known storage of a remote client
+        Storage only holds keys changed since the node started receiving
+        events of the client, and least recently active clients are
+        forgotten when their ON_CLOSE event is missed
+        """
+        storage = self.storages.pop(client_id, None)
+        if storage is None:
+            storage = {}
+
+        if message_type != ON_CLOSE:
+            self.storages[client_id] = storage
+
+            if len(self.storages) > self.storages_size:
+                self.storages.popitem(last=False)
+
+        if storage_delta:
+            storage.update(storage_delta['changed'])
+
+            for key in storage_delta['removed']:
+                storage.pop(key, None)
+
+        return storage
+
     def exit(self):
         """
         Called before closing the connection to subscriber
@@ -125,6 +258,25 @@ class BaseBackend(object):
 
     def __init__(self, settings):
         self.settings = settings
+        self.node_id = self.settings.get('NODE_ID') or uuid4().hex
+
+    def get_envelope(self):
+        """
+        Returns the envelope used to pack and unpack messages
+        """
+        return Envelope(
+            serializer=self.settings.get('SERIALIZER', 'pickle'),
+            accept=self.settings.get('ACCEPT_SERIALIZERS', None))
+
+    def get_directory(self):
+        """
+        Returns the clients directory if enabled
+        """
+        if self.settings.get('DIRECTORY', False):
+            from ..directory import MemoryDirectory
+            return MemoryDirectory()
+
+        return None
 
     def get_publisher_kwargs(self):
         """
@@ -136,7 +288,30 @@ class BaseBackend(object):
         """
         Returns a publisher instance
         """
-        return self.publisher_class(**self.get_publisher_kwargs())
+        publisher = self.publisher_class(
+            envelope=self.get_envelope(),
+            node_id=self.node_id,
+            timestamps=self.settings.get('ROUND_TRIP_METRICS', False),
+            **self.get_publisher_kwargs())
+
+        if self.settings.get('RECONNECT', False):
+            from .resilient import ResilientPublisher
+
+            publisher = ResilientPublisher(
+                publisher,
+                buffer_size=self.settings.get('RECONNECT_BUFFER_SIZE', 10000),
+                delay=self.settings.get('RECONNECT_DELAY', 0.1),
+                max_delay=self.settings.get('RECONNECT_MAX_DELAY', 30))
+
+        if self.settings.get('ASYNC_PUBLISHER', False):
+            from .threaded import ThreadedPublisher
+
+            publisher = ThreadedPublisher(
+                publisher,
+                queue_size=self.settings.get('PUBLISHER_QUEUE_SIZE', 10000),
+                overflow=self.settings.get('PUBLISHER_OVERFLOW', 'drop'))
+
+        return publisher
 
     def get_subscriber_kwargs(self):
         """
@@ -148,4 +323,8 @@ class BaseBackend(object):
         """
         Returns a subscriber instance
         """
-        return self.subscriber_class(**self.get_subscriber_kwargs())
+        return self.subscriber_class(
+            envelope=self.get_envelope(),
+            node_id=self.node_id,
+            storages_size=self.settings.get('REMOTE_STORAGES_SIZE', 10000),
+            **self.get_subscriber_kwargs())
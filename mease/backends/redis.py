@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from threading import Condition
+from threading import Lock
 from threading import Thread
+from time import sleep
+from time import time
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ReconnectingClientFactory
 
 from .. import logger
 
@@ -13,20 +20,44 @@ except ImportError:
 from .base import BasePublisher
 from .base import BaseSubscriber
 from .base import BaseBackend
+from .base import NODE_KEY
+from .resp import RedisError
+from .resp import encode_command
+from .resp import parse_replies
+from ..messages import ON_SEND
+from ..messages import ON_CLIENT_SEND
 
-__all__ = ('RedisPublisher', 'RedisSubscriber', 'RedisBackend')
+__all__ = (
+    'RedisPublisher', 'RedisSubscriber', 'RedisReactorSubscriber', 'RedisBackend',
+    'RedisStreamsPublisher', 'RedisStreamsSubscriber', 'RedisStreamsBackend')
 
 
 class RedisBackendMixin(object):
     """
     Redis backend mixin that sets connection settings
     """
-    def __init__(self, host, port, password, channel, *args, **kwargs):
+    def __init__(self, host, port, password, channel, routed=False, *args, **kwargs):
         super(RedisBackendMixin, self).__init__(*args, **kwargs)
         self.host = host
         self.port = port
         self.password = password
         self.channel = channel
+        self.routed = routed
+
+    def get_send_channel(self, routing):
+        """
+        Returns the channel of a routing key
+        """
+        if routing is None:
+            return '{channel}:send'.format(channel=self.channel)
+
+        return '{channel}:send:{routing}'.format(channel=self.channel, routing=routing)
+
+    def get_node_channel(self, node_id):
+        """
+        Returns the channel of a node
+        """
+        return '{channel}:node:{node_id}'.format(channel=self.channel, node_id=node_id)
 
     def connect(self):
         """
@@ -39,18 +70,143 @@ class RedisBackendMixin(object):
 class RedisPublisher(RedisBackendMixin, BasePublisher):
     """
     Publisher using Redis PUB
+    Messages can be batched in a pipeline every `batch_size` messages
+    or `batch_interval` milliseconds
     """
+    def __init__(self, batch_size=0, batch_interval=10, pool_size=None, *args, **kwargs):
+        super(RedisPublisher, self).__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval / 1000.0
+
+        self.buffer = []
+        self.closed = False
+        self.condition = Condition()
+        self.flush_lock = Lock()
+        self.thread = None
+
+    def connect(self):
+        """
+        Connects to Redis and starts the batching thread
+        Uses a pool of at most `pool_size` connections if given
+        """
+        if getattr(self, 'client', None) is not None:
+            self.client.connection_pool.disconnect()
+
+        if self.pool_size:
+            self.client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+                host=self.host, port=self.port, password=self.password,
+                max_connections=self.pool_size))
+        else:
+            super(RedisPublisher, self).connect()
+
+        if self.batch_size and self.thread is None:
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get_connection_errors(self):
+        return super(RedisPublisher, self).get_connection_errors() + (
+            redis.ConnectionError, redis.TimeoutError)
+
+    def get_channel(self, message_type, kwargs):
+        """
+        Returns the channel of a message
+        Messages are sent to a single node when a node is given
+        """
+        node_id = kwargs.pop(NODE_KEY, None)
+
+        if not self.routed:
+            return self.channel
+
+        if node_id is not None:
+            return self.get_node_channel(node_id)
+
+        if message_type == ON_SEND:
+            return self.get_send_channel(kwargs.get('routing'))
+
+        # Every node listens to the global send channel
+        if message_type == ON_CLIENT_SEND:
+            return self.get_send_channel(None)
+
+        return self.channel
+
     def publish(self, message_type, client_id, client_storage, *args, **kwargs):
         """
         Publishes a message
         """
+        channel = self.get_channel(message_type, kwargs)
         p = self.pack(message_type, client_id, client_storage, args, kwargs)
-        self.client.publish(self.channel, p)
+
+        if not self.batch_size:
+            self.send(self.client, channel, p)
+            return
+
+        with self.condition:
+            self.buffer.append((channel, p))
+
+            # Wake up the batching thread on first and last message of a batch
+            if len(self.buffer) in (1, self.batch_size):
+                self.condition.notify()
+
+    def send(self, client, channel, message):
+        """
+        Sends a packed message with a Redis client or pipeline
+        """
+        client.publish(channel, message)
+
+    def run(self):
+        """
+        Flushes batches until the publisher exits
+        """
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+
+                if not self.buffer:
+                    return
+
+                # Wait for a full batch or the end of the batch interval
+                deadline = time() + self.batch_interval
+
+                while len(self.buffer) < self.batch_size and not self.closed:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Unable to publish messages batch")
+
+    def flush(self):
+        """
+        Publishes buffered messages in a single pipeline
+        """
+        with self.flush_lock:
+            with self.condition:
+                batch, self.buffer = self.buffer, []
+
+            if batch:
+                pipe = self.client.pipeline(transaction=False)
+                for channel, p in batch:
+                    self.send(pipe, channel, p)
+                pipe.execute()
 
     def exit(self):
         """
-        Closes the connection
+        Flushes buffered messages and closes the connection
         """
+        if self.thread is not None:
+            with self.condition:
+                self.closed = True
+                self.condition.notify()
+
+            self.thread.join()
+
+        self.flush()
         self.client.connection_pool.disconnect()
 
 
@@ -68,40 +224,148 @@ class RedisSubscriber(RedisBackendMixin, BaseSubscriber):
         super(RedisSubscriber, self).connect()
         logger.info("Successfully connected to Redis")
 
-        # Subscribe to channel
+        # Subscribe to channels
+        channels, patterns = self.get_subscriptions()
+
         self.pubsub = self.client.pubsub()
-        self.pubsub.subscribe(self.channel)
+        self.pubsub.subscribe(*channels)
+        if patterns:
+            self.pubsub.psubscribe(*patterns)
 
-        logger.info("Subscribed to [{channel}] Redis channel".format(
-            channel=self.channel))
+        logger.info("Subscribed to [{channels}] Redis channels".format(
+            channels=', '.join(channels + patterns)))
 
         # Start listening
         t = Thread(target=self.listen)
         t.setDaemon(True)
         t.start()
 
+    def get_subscriptions(self):
+        """
+        Returns channels and channel patterns to subscribe to
+        Node and senders channels are used when messages are routed, and
+        client events of other nodes are ignored in local dispatch mode
+        """
+        if not self.routed:
+            return [self.channel], []
+
+        channels = []
+        patterns = []
+
+        if not self.factory.local_dispatch:
+            channels.append(self.channel)
+
+        channels.extend([
+            self.get_node_channel(self.node_id), self.get_send_channel(None)])
+        routings = self.get_send_routings()
+
+        if routings is None:
+            patterns.append(self.get_send_channel('*'))
+        else:
+            channels.extend(self.get_send_channel(r) for r in routings)
+
+        return channels, patterns
+
     def listen(self):
         """
         Listen for messages
         """
         for message in self.pubsub.listen():
-            if message['type'] == 'message':
-                message_type, client_id, client_storage, args, kwargs = self.unpack(
-                    message['data'])
-
-                self.dispatch_message(
-                    message_type, client_id, client_storage, args, kwargs)
+            if message['type'] in ('message', 'pmessage'):
+                self.handle_message(message['data'])
 
     def exit(self):
         """
         Closes the connection
         """
         self.pubsub.unsubscribe()
+        self.pubsub.punsubscribe()
         self.client.connection_pool.disconnect()
 
         logger.info("Connection to Redis closed")
 
 
+class RedisSubscriberProtocol(Protocol):
+    """
+    Redis SUB protocol running in the reactor
+    """
+    def connectionMade(self):
+        """
+        Subscribes to channels
+        """
+        self.factory.resetDelay()
+        self.buffer = b''
+
+        subscriber = self.factory.subscriber
+        channels, patterns = subscriber.get_subscriptions()
+
+        commands = []
+        if subscriber.password:
+            commands.append(encode_command('AUTH', subscriber.password))
+        commands.append(encode_command('SUBSCRIBE', *channels))
+        if patterns:
+            commands.append(encode_command('PSUBSCRIBE', *patterns))
+
+        self.transport.write(b''.join(commands))
+
+        logger.info("Subscribed to [{channels}] Redis channels".format(
+            channels=', '.join(channels + patterns)))
+
+    def dataReceived(self, data):
+        """
+        Dispatches every complete message received
+        """
+        replies, self.buffer = parse_replies(self.buffer + data)
+
+        for reply in replies:
+            self.factory.subscriber.handle_reply(reply)
+
+
+class RedisSubscriberFactory(ReconnectingClientFactory):
+    protocol = RedisSubscriberProtocol
+    maxDelay = 10
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+
+
+class RedisReactorSubscriber(RedisSubscriber):
+    """
+    Subscriber using Redis SUB in the reactor, without listening thread
+    """
+    def connect(self):
+        """
+        Connects to Redis
+        """
+        logger.info("Connecting to Redis on {host}:{port}...".format(
+            host=self.host, port=self.port))
+
+        self.client_factory = RedisSubscriberFactory(self)
+        self.connector = reactor.connectTCP(self.host, self.port, self.client_factory)
+
+    def handle_reply(self, reply):
+        """
+        Handles a Redis reply
+        """
+        if isinstance(reply, RedisError):
+            logger.error("Redis error : {error}".format(error=reply))
+
+        elif reply[0] == b'message':
+            self.handle_message(reply[2])
+
+        elif reply[0] == b'pmessage':
+            self.handle_message(reply[3])
+
+    def exit(self):
+        """
+        Closes the connection
+        """
+        self.client_factory.stopTrying()
+        self.connector.disconnect()
+
+        logger.info("Connection to Redis closed")
+
+
 class RedisBackend(BaseBackend):
     """
     Redis Backend using PUB/SUB
@@ -117,6 +381,27 @@ class RedisBackend(BaseBackend):
         self.port = self.settings.get('PORT', 6379)
         self.channel = self.settings.get('CHANNEL', 'mease')
         self.password = self.settings.get('PASSWORD', None)
+        self.routed = self.settings.get('ROUTED_CHANNELS', False)
+
+        if self.settings.get('REACTOR_SUBSCRIBER', False):
+            self.subscriber_class = RedisReactorSubscriber
+
+        self.batch_size = self.settings.get('BATCH_SIZE', 0)
+        self.batch_interval = self.settings.get('BATCH_INTERVAL', 10)
+
+    def get_directory(self):
+        """
+        Returns a Redis clients directory if enabled
+        """
+        if not self.settings.get('DIRECTORY', False):
+            return None
+
+        from ..directory import RedisDirectory
+
+        return RedisDirectory(
+            redis.Redis(host=self.host, port=self.port, password=self.password),
+            key='{channel}:clients'.format(channel=self.channel),
+            ttl=self.settings.get('DIRECTORY_TTL', 30))
 
     def get_kwargs(self):
         """
@@ -126,8 +411,171 @@ class RedisBackend(BaseBackend):
             'host': self.host,
             'port': self.port,
             'channel': self.channel,
-            'password': self.password
+            'password': self.password,
+            'routed': self.routed
         }
 
-    get_publisher_kwargs = get_kwargs
+    def get_publisher_kwargs(self):
+        """
+        Returns kwargs for publisher class
+        """
+        kwargs = self.get_kwargs()
+        kwargs.update({
+            'batch_size': self.batch_size,
+            'batch_interval': self.batch_interval,
+            'pool_size': self.settings.get('POOL_SIZE', None)
+        })
+        return kwargs
+
     get_subscriber_kwargs = get_kwargs
+
+
+class RedisStreamsPublisher(RedisPublisher):
+    """
+    Publisher using Redis Streams XADD
+    Streams are trimmed to approximately `maxlen` messages
+    """
+    def __init__(self, maxlen=10000, *args, **kwargs):
+        super(RedisStreamsPublisher, self).__init__(*args, **kwargs)
+        self.maxlen = maxlen
+
+    def send(self, client, channel, message):
+        """
+        Adds a packed message to the stream
+        """
+        client.xadd(channel, {'m': message}, maxlen=self.maxlen, approximate=True)
+
+
+class RedisStreamsSubscriber(RedisBackendMixin, BaseSubscriber):
+    """
+    Subscriber using Redis Streams XREAD
+    Reads up to `count` messages at once. When `cursor_ttl` is given, the last
+    read id is stored for `cursor_ttl` seconds so that a node restarted with
+    the same NODE_ID resumes where it stopped
+    """
+    def __init__(self, count=100, block=1000, cursor_ttl=None, *args, **kwargs):
+        super(RedisStreamsSubscriber, self).__init__(*args, **kwargs)
+        self.count = count
+        self.block = block
+        self.cursor_ttl = cursor_ttl
+        self.closed = False
+
+    def get_cursor_key(self):
+        """
+        Returns the key holding the last read id of the node
+        """
+        return '{stream}:cursor:{node_id}'.format(stream=self.channel, node_id=self.node_id)
+
+    def connect(self):
+        """
+        Connects to Redis
+        """
+        logger.info("Connecting to Redis on {host}:{port}...".format(
+            host=self.host, port=self.port))
+
+        super(RedisStreamsSubscriber, self).connect()
+
+        # Resume from the last read message, or only read new messages
+        self.last_id = None
+        if self.cursor_ttl:
+            self.last_id = self.client.get(self.get_cursor_key())
+
+        if self.last_id is None:
+            last_messages = self.client.xrevrange(self.channel, count=1)
+            self.last_id = last_messages[0][0] if last_messages else '0-0'
+
+        logger.info("Reading [{stream}] Redis stream from {last_id}".format(
+            stream=self.channel, last_id=self.last_id))
+
+        # Start listening
+        t = Thread(target=self.listen)
+        t.daemon = True
+        t.start()
+
+    def read(self):
+        """
+        Reads and handles a batch of messages
+        """
+        response = self.client.xread(
+            {self.channel: self.last_id}, count=self.count, block=self.block)
+
+        if not response:
+            return
+
+        for _, messages in response:
+            for message_id, fields in messages:
+                # Move past the message first, so that a failing message isn't read again
+                self.last_id = message_id
+                self.handle_message(fields[b'm'])
+
+        if self.cursor_ttl:
+            self.client.set(self.get_cursor_key(), self.last_id, ex=self.cursor_ttl)
+
+    def listen(self):
+        """
+        Reads messages until the subscriber is closed
+        """
+        while not self.closed:
+            try:
+                self.read()
+            except Exception:
+                if self.closed:
+                    break
+
+                logger.exception("Unable to read Redis stream")
+                sleep(1)
+
+    def exit(self):
+        """
+        Closes the connection
+        """
+        self.closed = True
+        self.client.connection_pool.disconnect()
+
+        logger.info("Connection to Redis closed")
+
+
+class RedisStreamsBackend(RedisBackend):
+    """
+    Redis Backend using Streams
+    """
+    name = "Redis Streams"
+    publisher_class = RedisStreamsPublisher
+    subscriber_class = RedisStreamsSubscriber
+
+    def __init__(self, *args, **kwargs):
+        super(RedisStreamsBackend, self).__init__(*args, **kwargs)
+
+        self.channel = self.settings.get('STREAM', 'mease:stream')
+        self.maxlen = self.settings.get('STREAM_MAXLEN', 10000)
+        self.count = self.settings.get('READ_COUNT', 100)
+        self.block = self.settings.get('READ_BLOCK', 1000)
+
+        # Cursors are only stored for nodes that keep their id after a restart
+        self.cursor_ttl = None
+        if self.settings.get('NODE_ID'):
+            self.cursor_ttl = self.settings.get('CURSOR_TTL', 86400)
+
+        # Streams are not routed and read by a listening thread
+        self.routed = False
+        self.subscriber_class = RedisStreamsSubscriber
+
+    def get_publisher_kwargs(self):
+        """
+        Returns kwargs for publisher class
+        """
+        kwargs = super(RedisStreamsBackend, self).get_publisher_kwargs()
+        kwargs['maxlen'] = self.maxlen
+        return kwargs
+
+    def get_subscriber_kwargs(self):
+        """
+        Returns kwargs for subscriber class
+        """
+        kwargs = self.get_kwargs()
+        kwargs.update({
+            'count': self.count,
+            'block': self.block,
+            'cursor_ttl': self.cursor_ttl
+        })
+        return kwargs
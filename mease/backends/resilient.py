@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from threading import RLock
+from threading import Timer
+from twisted.internet import reactor
+
+from .. import logger
+from .base import BasePublisher
+
+__all__ = ('ResilientPublisher',)
+
+
+class ResilientPublisher(BasePublisher):
+    """
+    Publisher wrapper that buffers messages while the broker is unreachable,
+    reconnects with an exponential backoff and replays buffered messages in order
+    When the buffer is full, the oldest messages are dropped
+    Messages are replayed `replay_size` at a time, so that new messages are
+    buffered meanwhile instead of waiting for the whole replay
+    """
+    def __init__(self, publisher, buffer_size=10000, delay=0.1, max_delay=30,
+                 replay_size=100, *args, **kwargs):
+        super(ResilientPublisher, self).__init__(*args, **kwargs)
+
+        # The wrapped publisher is closed by this one
+        self.publisher = publisher
+        reactor.removeSystemEventTrigger(self.publisher.shutdown_trigger)
+
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.delay = delay
+        self.max_delay = max_delay
+        self.replay_size = replay_size
+
+        self.lock = RLock()
+        self.failures = 0
+        self.timer = None
+        self.closed = False
+
+        self.published = 0
+        self.reconnects = 0
+        self.dropped = 0
+
+    def get_connection_errors(self):
+        return self.publisher.get_connection_errors()
+
+    def connect(self):
+        """
+        Connects the wrapped publisher
+        """
+        with self.lock:
+            try:
+                self.publisher.connect()
+            except self.get_connection_errors() as e:
+                self.disconnected(e)
+
+    def publish(self, *args, **kwargs):
+        """
+        Publishes a message, or buffers it while disconnected
+        """
+        with self.lock:
+            if self.failures:
+                self.buffer_message(args, kwargs)
+                return
+
+            try:
+                self.publisher.publish(*args, **kwargs)
+                self.published += 1
+            except self.get_connection_errors() as e:
+                self.buffer_message(args, kwargs)
+                self.disconnected(e)
+
+    def buffer_message(self, args, kwargs):
+        """
+        Buffers a message, dropping the oldest one if the buffer is full
+        """
+        if len(self.buffer) >= self.buffer_size:
+            self.buffer.popleft()
+            self.dropped += 1
+
+        self.buffer.append((args, kwargs))
+
+    def disconnected(self, error):
+        """
+        Schedules a reconnection
+        """
+        self.failures += 1
+        delay = min(self.max_delay, self.delay * 2 ** (self.failures - 1))
+
+        logger.warning(
+            "Publisher disconnected ({error}), reconnecting in {delay}s".format(
+                error=error, delay=delay))
+
+        self.timer = Timer(delay, self.reconnect)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def reconnect(self):
+        """
+        Reconnects and replays buffered messages
+        Messages published meanwhile are buffered after the replayed ones
+        """
+        with self.lock:
+            if self.closed:
+                return
+
+            self.timer = None
+            self.reconnects += 1
+
+        try:
+            self.publisher.connect()
+        except self.get_connection_errors() as e:
+            with self.lock:
+                self.disconnected(e)
+            return
+
+        while self.replay():
+            pass
+
+    def replay(self):
+        """
+        Replays up to `replay_size` buffered messages
+        Returns True while messages remain to be replayed
+        """
+        with self.lock:
+            if self.closed:
+                return False
+
+            try:
+                for _ in range(self.replay_size):
+                    if not self.buffer:
+                        break
+
+                    args, kwargs = self.buffer[0]
+                    self.publisher.publish(*args, **kwargs)
+                    self.buffer.popleft()
+                    self.published += 1
+
+            except self.get_connection_errors() as e:
+                self.disconnected(e)
+                return False
+
+            if self.buffer:
+                return True
+
+            self.failures = 0
+
+            logger.info("Publisher reconnected")
+            return False
+
+    def stats(self):
+        """
+        Returns publisher counters
+        """
+        with self.lock:
+            return {
+                'connected': not self.failures,
+                'buffered': len(self.buffer),
+                'published': self.published,
+                'reconnects': self.reconnects,
+                'dropped': self.dropped
+            }
+
+    def flush(self):
+        with self.lock:
+            if not self.failures:
+                self.publisher.flush()
+
+    def exit(self):
+        """
+        Closes the wrapped publisher, dropping messages that were not replayed
+        """
+        with self.lock:
+            self.closed = True
+
+            if self.timer is not None:
+                self.timer.cancel()
+
+            if self.buffer:
+                logger.warning("Dropping {count} buffered messages".format(
+                    count=len(self.buffer)))
+                self.dropped += len(self.buffer)
+                self.buffer.clear()
+
+            self.publisher.exit()
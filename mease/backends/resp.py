@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal Redis serialization protocol (RESP) encoder and parser
+"""
+
+__all__ = ('RedisError', 'encode_command', 'parse_replies')
+
+
+class RedisError(Exception):
+    """
+    Error reply sent by Redis
+    """
+    pass
+
+
+class _Incomplete(Exception):
+    pass
+
+
+def encode_command(*args):
+    """
+    Encodes a command as an array of bulk strings
+    """
+    parts = [b'*' + str(len(args)).encode() + b'\r\n']
+
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n')
+
+    return b''.join(parts)
+
+
+def _parse(data, pos):
+    """
+    Parses a reply starting at `pos` and returns it with the position of the next reply
+    """
+    end = data.find(b'\r\n', pos)
+    if end == -1:
+        raise _Incomplete()
+
+    kind, line = data[pos:pos + 1], data[pos + 1:end]
+    pos = end + 2
+
+    if kind == b'+':
+        return line, pos
+
+    if kind == b'-':
+        return RedisError(line.decode('utf-8', 'replace')), pos
+
+    if kind == b':':
+        return int(line), pos
+
+    if kind == b'$':
+        length = int(line)
+        if length == -1:
+            return None, pos
+        if len(data) < pos + length + 2:
+            raise _Incomplete()
+        return data[pos:pos + length], pos + length + 2
+
+    if kind == b'*':
+        length = int(line)
+        if length == -1:
+            return None, pos
+        items = []
+        for _ in range(length):
+            item, pos = _parse(data, pos)
+            items.append(item)
+        return items, pos
+
+    raise ValueError("Invalid RESP reply type : {kind!r}".format(kind=kind))
+
+
+def parse_replies(data):
+    """
+    Parses every complete reply in `data`
+    Returns the replies and the remaining incomplete data
+    """
+    replies = []
+    pos = 0
+
+    while pos < len(data):
+        try:
+            reply, pos = _parse(data, pos)
+        except _Incomplete:
+            break
+        replies.append(reply)
+
+    return replies, data[pos:]
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from threading import Thread
+from twisted.internet import reactor
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+from .. import logger
+from .base import BasePublisher
+from .base import PublisherOverflow
+
+__all__ = ('OVERFLOW_DROP', 'OVERFLOW_BLOCK', 'OVERFLOW_DISCONNECT', 'ThreadedPublisher')
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DISCONNECT = 'disconnect'
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_BLOCK, OVERFLOW_DISCONNECT)
+
+_STOP = object()
+_FLUSH = object()
+
+
+class ThreadedPublisher(BasePublisher):
+    """
+    Publisher wrapper that queues messages and publishes them from a writer thread
+    so that the caller never waits on the broker
+    """
+    def __init__(self, publisher, queue_size=10000, overflow=OVERFLOW_DROP,
+                 *args, **kwargs):
+        super(ThreadedPublisher, self).__init__(*args, **kwargs)
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy : {overflow}".format(
+                overflow=overflow))
+
+        # The wrapped publisher is closed by this one, after the queue is drained
+        self.publisher = publisher
+        reactor.removeSystemEventTrigger(self.publisher.shutdown_trigger)
+
+        self.queue = Queue(maxsize=queue_size)
+        self.overflow = overflow
+
+        self.published = 0
+        self.dropped = 0
+
+    def connect(self):
+        """
+        Connects the wrapped publisher and starts the writer thread
+        """
+        self.publisher.connect()
+
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, message_type, client_id=None, client_storage=None,
+                *args, **kwargs):
+        """
+        Queues a message
+        Client storage is copied as it may change before the message is sent
+        """
+        if client_storage is not None:
+            client_storage = dict(client_storage)
+
+        item = (message_type, client_id, client_storage, args, kwargs)
+
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(item)
+            return
+
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.dropped += 1
+
+            if self.overflow == OVERFLOW_DISCONNECT:
+                raise PublisherOverflow(
+                    "Publisher queue is full ({size} messages)".format(
+                        size=self.queue.maxsize))
+
+    def run(self):
+        """
+        Publishes queued messages until the publisher exits
+        """
+        while True:
+            item = self.queue.get()
+
+            if item is _STOP:
+                break
+
+            if item is _FLUSH:
+                try:
+                    self.publisher.flush()
+                except Exception:
+                    logger.exception("Unable to flush publisher")
+                continue
+
+            message_type, client_id, client_storage, args, kwargs = item
+
+            try:
+                self.publisher.publish(
+                    message_type, client_id, client_storage, *args, **kwargs)
+                self.published += 1
+            except Exception:
+                self.dropped += 1
+                logger.exception("Unable to publish message")
+
+    def flush(self):
+        """
+        Flushes the wrapped publisher after messages queued before
+        """
+        if getattr(self, 'thread', None) is None:
+            self.publisher.flush()
+            return
+
+        self.queue.put(_FLUSH)
+
+    def stats(self):
+        """
+        Returns queue statistics
+        """
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'published': self.published,
+            'dropped': self.dropped
+        }
+
+    def exit(self):
+        """
+        Publishes remaining messages and closes the wrapped publisher
+        """
+        if getattr(self, 'thread', None) is not None:
+            self.queue.put(_STOP)
+            self.thread.join()
+
+        self.publisher.exit()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+from threading import Thread
+
+try:
+    import asyncio
+    from concurrent.futures import wait
+except ImportError:
+    asyncio = None
+
+from . import logger
+
+__all__ = ('iscoroutine', 'get_event_loop', 'run_coroutine', 'wait_coroutine')
+
+_loop = None
+_loop_lock = Lock()
+
+
+def iscoroutine(obj):
+    """
+    Returns True if an object is a coroutine (`async def` callback result)
+    """
+    # Most callbacks return None, skip the slower asyncio check for them
+    return obj is not None and asyncio is not None and asyncio.iscoroutine(obj)
+
+
+def get_event_loop():
+    """
+    Returns the asyncio loop used to run coroutines
+    With Twisted asyncio reactor, the reactor loop is used
+    Otherwise a loop is started in a background thread
+    """
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            from twisted.internet import reactor
+
+            _loop = getattr(reactor, '_asyncioEventloop', None)
+
+            if _loop is None:
+                _loop = asyncio.new_event_loop()
+
+                t = Thread(target=_loop.run_forever)
+                t.daemon = True
+                t.start()
+
+    return _loop
+
+
+def run_coroutine(coro):
+    """
+    Schedules a coroutine on the asyncio loop and returns its future
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    future.add_done_callback(_log_exception)
+    return future
+
+
+def wait_coroutine(future):
+    """
+    Waits for a coroutine future to be done, its errors are already logged
+    """
+    wait([future])
+
+
+def _log_exception(future):
+    """
+    Logs coroutine errors
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Error in callback coroutine", exc_info=future.exception())
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ('BaseDirectory', 'MemoryDirectory', 'RedisDirectory')
+
+
+class BaseDirectory(object):
+    """
+    Base directory that maps connected clients to their node
+    """
+    heartbeat_interval = None
+
+    def register(self, client_id, node_id):
+        """
+        Registers a client connected to a node
+        """
+        raise NotImplementedError(
+            "You need to implement the `register` method for your directory")
+
+    def unregister(self, client_id, node_id=None):
+        """
+        Unregisters a client of a node
+        """
+        raise NotImplementedError(
+            "You need to implement the `unregister` method for your directory")
+
+    def lookup(self, client_id):
+        """
+        Returns the node of a client, or None if unknown
+        """
+        raise NotImplementedError(
+            "You need to implement the `lookup` method for your directory")
+
+    def heartbeat(self, node_id):
+        """
+        Called every `heartbeat_interval` seconds while a node is running
+        """
+        pass
+
+
+class MemoryDirectory(BaseDirectory):
+    """
+    In-memory directory that only knows clients of the current process
+    """
+    def __init__(self):
+        self.clients = {}
+
+    def register(self, client_id, node_id):
+        self.clients[client_id] = node_id
+
+    def unregister(self, client_id, node_id=None):
+        self.clients.pop(client_id, None)
+
+    def lookup(self, client_id):
+        return self.clients.get(client_id)
+
+
+class RedisDirectory(BaseDirectory):
+    """
+    Directory stored in a Redis hash, with a set of clients for each node
+    Each node refreshes a heartbeat key expiring after `ttl` seconds,
+    so that clients of stopped nodes are ignored, then removed by running nodes
+    """
+    def __init__(self, client, key, ttl=30):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.heartbeat_interval = ttl / 3.0
+
+    def get_node_key(self, node_id):
+        """
+        Returns the heartbeat key of a node
+        """
+        return '{key}:node:{node_id}'.format(key=self.key, node_id=node_id)
+
+    def get_clients_key(self, node_id):
+        """
+        Returns the key of the clients set of a node
+        """
+        return '{key}:node:{node_id}:clients'.format(key=self.key, node_id=node_id)
+
+    def get_nodes_key(self):
+        """
+        Returns the key of the nodes set
+        """
+        return '{key}:nodes'.format(key=self.key)
+
+    def register(self, client_id, node_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(self.key, client_id, node_id)
+        pipe.sadd(self.get_clients_key(node_id), client_id)
+        pipe.execute()
+
+    def unregister(self, client_id, node_id=None):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hdel(self.key, client_id)
+        if node_id is not None:
+            pipe.srem(self.get_clients_key(node_id), client_id)
+        pipe.execute()
+
+    def lookup(self, client_id):
+        node_id = self.client.hget(self.key, client_id)
+
+        if node_id is None:
+            return None
+
+        if isinstance(node_id, bytes):
+            node_id = node_id.decode('utf-8')
+
+        # Remove clients of stopped nodes
+        if not self.client.exists(self.get_node_key(node_id)):
+            self.client.hdel(self.key, client_id)
+            return None
+
+        return node_id
+
+    def heartbeat(self, node_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.get_node_key(node_id), 1, ex=self.ttl)
+        pipe.sadd(self.get_nodes_key(), node_id)
+        pipe.execute()
+
+        self.remove_stopped_nodes()
+
+    def remove_stopped_nodes(self):
+        """
+        Removes clients of nodes that stopped refreshing their heartbeat
+        """
+        for node_id in self.client.smembers(self.get_nodes_key()):
+            if isinstance(node_id, bytes):
+                node_id = node_id.decode('utf-8')
+
+            if self.client.exists(self.get_node_key(node_id)):
+                continue
+
+            clients_key = self.get_clients_key(node_id)
+            clients = self.client.smembers(clients_key)
+
+            pipe = self.client.pipeline(transaction=False)
+            if clients:
+                pipe.hdel(self.key, *clients)
+            pipe.delete(clients_key)
+            pipe.srem(self.get_nodes_key(), node_id)
+            pipe.execute()
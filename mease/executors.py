@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+from itertools import count
+from threading import Lock
+from threading import Thread
+from time import time
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread
+from twisted.python.threadable import isInIOThread
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+
+from . import logger
+
+__all__ = (
+    'SHED_NEWEST', 'SHED_OLDEST', 'SHED_BLOCK',
+    'ReactorExecutor', 'InlineExecutor', 'ThreadPoolExecutor', 'OrderedExecutor')
+
+SHED_NEWEST = 'drop'
+SHED_OLDEST = 'drop_oldest'
+SHED_BLOCK = 'block'
+
+SHED_POLICIES = (SHED_NEWEST, SHED_OLDEST, SHED_BLOCK)
+
+_STOP = object()
+
+
+class BaseExecutor(object):
+    """
+    Base executor that runs callbacks of incoming messages
+    Executors running functions in order wait for coroutine callbacks
+    """
+    ordered = False
+
+    def start(self):
+        """
+        Starts the executor
+        """
+        pass
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs a function
+        """
+        raise NotImplementedError(
+            "You need to implement the `submit` method for your executor")
+
+    def submit_to(self, key, func, *args, **kwargs):
+        """
+        Runs a function after previous functions submitted with the same key
+        Executors that don't keep order ignore the key
+        """
+        self.submit(func, *args, **kwargs)
+
+    def stats(self):
+        """
+        Returns executor statistics
+        """
+        return {}
+
+    def stop(self):
+        """
+        Stops the executor
+        """
+        pass
+
+
+class ReactorExecutor(BaseExecutor):
+    """
+    Runs functions in the reactor thread pool
+    """
+    def submit(self, func, *args, **kwargs):
+        reactor.callInThread(func, *args, **kwargs)
+
+
+class InlineExecutor(BaseExecutor):
+    """
+    Runs functions in the calling thread
+    """
+    def submit(self, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Error in callback function")
+
+
+class ThreadPoolExecutor(BaseExecutor):
+    """
+    Runs functions in a fixed size thread pool fed by a bounded queue
+    When the queue is full, new tasks are dropped, the oldest queued task
+    is dropped or the caller waits, depending on `overflow`
+    """
+    def __init__(self, size=10, queue_size=10000, overflow=SHED_NEWEST):
+        if overflow not in SHED_POLICIES:
+            raise ValueError("Unknown overflow policy : {overflow}".format(
+                overflow=overflow))
+
+        self.size = size
+        self.queue = Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.threads = []
+
+        self.lock = Lock()
+        self.executed = 0
+        self.dropped = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def start(self):
+        """
+        Starts worker threads
+        """
+        for _ in range(self.size):
+            t = Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a function
+        """
+        task = (time(), func, args, kwargs)
+
+        if self.overflow == SHED_BLOCK:
+            self.queue.put(task)
+            return
+
+        try:
+            self.queue.put_nowait(task)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+            if self.overflow == SHED_OLDEST:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(task)
+                except (Empty, Full):
+                    pass
+
+    def run(self):
+        """
+        Runs queued functions until the executor stops
+        """
+        while True:
+            task = self.queue.get()
+
+            if task is _STOP:
+                break
+
+            queued_at, func, args, kwargs = task
+            wait_time = time() - queued_at
+
+            with self.lock:
+                self.executed += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Error in callback function")
+
+    def stats(self):
+        """
+        Returns queue depth, counters and task wait times in seconds
+        """
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'executed': self.executed,
+                'dropped': self.dropped,
+                'wait_time_avg': (
+                    self.wait_time_total / self.executed if self.executed else 0.0),
+                'wait_time_max': self.wait_time_max
+            }
+
+    def stop(self):
+        """
+        Runs queued functions and stops worker threads
+        In the reactor thread, returns a Deferred fired when threads are stopped
+        instead of blocking the reactor, as queued functions may wait on it
+        (like coroutine callbacks running on the asyncio reactor loop)
+        """
+        for _ in self.threads:
+            self.queue.put(_STOP)
+
+        if isInIOThread():
+            return deferToThread(self.join)
+
+        self.join()
+
+    def join(self):
+        """
+        Waits for worker threads to stop
+        """
+        for t in self.threads:
+            t.join()
+
+        self.threads = []
+
+
+class OrderedExecutor(BaseExecutor):
+    """
+    Runs functions in `lanes` single threaded lanes
+    Functions submitted with the same key always run in the same lane, in order,
+    while functions with different keys run in parallel
+    Lanes wait for coroutine callbacks to be done before running the next function
+    """
+    ordered = True
+
+    def __init__(self, lanes=10, queue_size=10000, overflow=SHED_NEWEST):
+        self.lanes = [
+            ThreadPoolExecutor(size=1, queue_size=queue_size, overflow=overflow)
+            for _ in range(lanes)]
+        self.counter = count()
+
+    def start(self):
+        """
+        Starts lanes
+        """
+        for lane in self.lanes:
+            lane.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a function in the next lane
+        """
+        lane = self.lanes[next(self.counter) % len(self.lanes)]
+        lane.submit(func, *args, **kwargs)
+
+    def submit_to(self, key, func, *args, **kwargs):
+        """
+        Queues a function in the lane of its key
+        """
+        lane = self.lanes[hash(key) % len(self.lanes)]
+        lane.submit(func, *args, **kwargs)
+
+    def stats(self):
+        """
+        Returns statistics summed over lanes
+        """
+        lanes_stats = [lane.stats() for lane in self.lanes]
+        executed = sum(s['executed'] for s in lanes_stats)
+
+        return {
+            'queue_depth': sum(s['queue_depth'] for s in lanes_stats),
+            'queue_size': sum(s['queue_size'] for s in lanes_stats),
+            'executed': executed,
+            'dropped': sum(s['dropped'] for s in lanes_stats),
+            'wait_time_avg': (
+                sum(s['wait_time_avg'] * s['executed'] for s in lanes_stats) / executed
+                if executed else 0.0),
+            'wait_time_max': max(s['wait_time_max'] for s in lanes_stats)
+        }
+
+    def stop(self):
+        """
+        Stops lanes
+        In the reactor thread, returns a Deferred fired when lanes are stopped
+        """
+        stopped = [lane.stop() for lane in self.lanes]
+
+        if isInIOThread():
+            return DeferredList(stopped)
@@ -2,9 +2,20 @@
 
 
 class FakeClient(object):
+    """
+    Client connected to another node, holding its storage
+    """
+    __slots__ = ('storage', 'factory')
+
     def __init__(self, storage, factory):
         self.storage = storage
         self.factory = factory
 
     def send(self, *args, **kwargs):
         pass
+
+    def join(self, group):
+        pass
+
+    def leave(self, group):
+        pass
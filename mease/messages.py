@@ -2,10 +2,14 @@ ON_OPEN = 1
 ON_CLOSE = 2
 ON_RECEIVE = 3
 ON_SEND = 4
+ON_CLIENT_SEND = 5
 
 MESSAGES_TYPES = (
     (ON_OPEN, 'OPEN'),
     (ON_CLOSE, 'CLOSE'),
     (ON_RECEIVE, 'RECEIVE'),
-    (ON_SEND, 'SEND')
+    (ON_SEND, 'SEND'),
+    (ON_CLIENT_SEND, 'CLIENT_SEND')
 )
+
+MESSAGES_NAMES = dict(MESSAGES_TYPES)
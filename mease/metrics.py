@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from threading import Lock
+from threading import local
+from twisted.web.resource import Resource
+
+__all__ = (
+    'Counter', 'Gauge', 'Histogram', 'MetricsRegistry', 'MeaseMetrics',
+    'MetricsResource')
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_value(value):
+    """
+    Formats a sample value
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    """
+    Formats sample labels
+    """
+    if not names:
+        return ''
+
+    return '{{{labels}}}'.format(labels=','.join(
+        '{name}="{value}"'.format(
+            name=name,
+            value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n'))
+        for name, value in zip(names, values)))
+
+
+class Metric(object):
+    """
+    Base metric with a value for each labels combination
+    Each thread updates its own values without locking, and values of
+    every thread are summed when the metric is rendered
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self.lock = Lock()
+        self.local = local()
+        self.threads_values = []
+
+    def initial_value(self):
+        """
+        Returns the value of a new labels combination
+        """
+        return 0
+
+    def get_values(self):
+        """
+        Returns values updated by the current thread
+        """
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+
+            with self.lock:
+                self.threads_values.append(values)
+
+            return values
+
+    def merge(self, total, value):
+        """
+        Adds a thread value to a total value
+        """
+        return value if total is None else total + value
+
+    def collect(self):
+        """
+        Returns values summed over threads
+        """
+        with self.lock:
+            threads_values = list(self.threads_values)
+
+        collected = {}
+        for values in threads_values:
+            for labels, value in list(values.items()):
+                collected[labels] = self.merge(collected.get(labels), value)
+
+        # Metrics without labels are exported before their first update
+        if not self.labels and () not in collected:
+            collected[()] = self.initial_value()
+
+        return collected
+
+    def samples(self):
+        """
+        Returns (name, label names, label values, value) samples
+        """
+        return [
+            (self.name, self.labels, labels, value)
+            for labels, value in sorted(self.collect().items())]
+
+    def render(self):
+        """
+        Returns metric in Prometheus text format
+        """
+        lines = [
+            '# HELP {name} {help}'.format(name=self.name, help=self.help),
+            '# TYPE {name} {type}'.format(name=self.name, type=self.type)]
+
+        for name, label_names, label_values, value in self.samples():
+            lines.append('{name}{labels} {value}'.format(
+                name=name,
+                labels=format_labels(label_names, label_values),
+                value=format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increments counter
+        """
+        values = self.get_values()
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, or is read from a function when rendered
+    Gauges are shared by threads and updated with a lock
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.values = {}
+        self.function = None
+
+    def set(self, value, labels=()):
+        """
+        Sets gauge value
+        """
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increments gauge
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        """
+        Decrements gauge
+        """
+        self.inc(-amount, labels)
+
+    def set_function(self, function):
+        """
+        Reads gauge value from a function when rendered
+        """
+        self.function = function
+
+    def collect(self):
+        if self.function is not None:
+            self.set(self.function())
+
+        with self.lock:
+            collected = dict(self.values)
+
+        if not self.labels and () not in collected:
+            collected[()] = self.initial_value()
+
+        return collected
+
+
+class Histogram(Metric):
+    """
+    Counts observed values in buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def initial_value(self):
+        return [[0] * len(self.buckets), 0.0, 0]
+
+    def observe(self, value, labels=()):
+        """
+        Adds a value
+        """
+        values = self.get_values()
+
+        data = values.get(labels)
+        if data is None:
+            data = values[labels] = self.initial_value()
+
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def merge(self, total, value):
+        counts, value_sum, count = value
+
+        if total is None:
+            return [list(counts), value_sum, count]
+
+        total[0] = [a + b for a, b in zip(total[0], counts)]
+        total[1] += value_sum
+        total[2] += count
+        return total
+
+    def samples(self):
+        bucket_labels = self.labels + ('le',)
+        samples = []
+
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((
+                    self.name + '_bucket', bucket_labels,
+                    labels + (format_value(bound),), cumulative))
+
+            samples.append((self.name + '_sum', self.labels, labels, total))
+            samples.append((self.name + '_count', self.labels, labels, count))
+
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Holds metrics and renders them in Prometheus text format
+    When `enabled` is False, mease doesn't update its metrics
+    """
+    def __init__(self, prefix='', enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.metrics = []
+
+    def add(self, metric):
+        """
+        Registers a metric
+        """
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """
+        Registers a counter
+        """
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        """
+        Registers a gauge
+        """
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Registers a histogram
+        """
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Returns every metric in Prometheus text format
+        """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class MeaseMetrics(MetricsRegistry):
+    """
+    Metrics updated by mease
+    """
+    def __init__(self, prefix='mease_', enabled=True):
+        super(MeaseMetrics, self).__init__(prefix, enabled)
+
+        self.connections = self.gauge(
+            'connections', "Open websocket connections")
+        self.frames_in = self.counter(
+            'frames_in_total', "Websocket frames received")
+        self.frames_out = self.counter(
+            'frames_out_total', "Websocket frames sent")
+        self.bytes_in = self.counter(
+            'bytes_in_total', "Websocket payload bytes received")
+        self.bytes_out = self.counter(
+            'bytes_out_total', "Websocket payload bytes sent")
+
+        self.published = self.counter(
+            'published_total', "Messages published on the backend", ['type'])
+        self.publish_latency = self.histogram(
+            'publish_seconds', "Time spent publishing a message")
+        self.received = self.counter(
+            'received_total', "Messages received from the backend", ['type'])
+        self.round_trip = self.histogram(
+            'round_trip_seconds',
+            "Time between publishing and receiving a backend message")
+
+        self.callback_latency = self.histogram(
+            'callback_seconds', "Callback functions duration", ['function'])
+        self.callback_errors = self.counter(
+            'callback_errors_total', "Callback functions exceptions", ['function'])
+        self.slow_callbacks = self.counter(
+            'slow_callbacks_total', "Callback functions calls over the profiler threshold",
+            ['function'])
+
+        self.executor_queue_depth = self.gauge(
+            'executor_queue_depth', "Callbacks waiting in the executor queue")
+        self.publisher_queue_depth = self.gauge(
+            'publisher_queue_depth', "Messages waiting in the publisher queue")
+
+
+class MetricsResource(Resource):
+    """
+    Twisted web resource serving metrics in Prometheus text format
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.render().encode('utf-8')
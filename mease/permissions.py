@@ -10,6 +10,6 @@ def passes_test(perm_func):
         def wrapper(*args, **kwargs):
             if not perm_func(*args, **kwargs):
                 return
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
         return wrapper
     return decored
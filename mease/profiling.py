@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from threading import Lock
+from time import time
+
+from . import logger
+
+__all__ = ('CallbackProfiler',)
+
+
+def percentile(values, q):
+    """
+    Returns the `q` percentile of sorted values
+    """
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class CallbackProfiler(object):
+    """
+    Times callback functions by name and keeps their last `window` durations
+    Calls lasting at least `threshold` seconds are logged and counted
+    """
+    def __init__(self, threshold=0.1, window=1000):
+        self.threshold = threshold
+        self.window = window
+
+        self.lock = Lock()
+        self.durations = {}
+        self.calls = {}
+        self.slow_calls = {}
+
+        # Counter incremented for slow calls, set by the registry
+        self.counter = None
+
+    def record(self, name, duration):
+        """
+        Records a call duration
+        """
+        with self.lock:
+            durations = self.durations.get(name)
+            if durations is None:
+                durations = self.durations[name] = deque(maxlen=self.window)
+
+            durations.append(duration)
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+            slow = duration >= self.threshold
+            if slow:
+                self.slow_calls[name] = self.slow_calls.get(name, 0) + 1
+
+        if slow:
+            self.slow_call(name, duration)
+
+    def record_future(self, name, start, future):
+        """
+        Records the duration of a coroutine call when its future is done
+        """
+        future.add_done_callback(lambda f: self.record(name, time() - start))
+
+    def slow_call(self, name, duration):
+        """
+        Called for calls lasting at least `threshold` seconds
+        """
+        logger.warning("Slow callback {name} : {duration:.3f}s".format(
+            name=name, duration=duration))
+
+        if self.counter is not None:
+            self.counter.inc(labels=(name,))
+
+    def stats(self):
+        """
+        Returns calls count, slow calls count and duration percentiles
+        in seconds over the window, by function name
+        """
+        with self.lock:
+            items = [
+                (name, sorted(durations), self.calls[name], self.slow_calls.get(name, 0))
+                for name, durations in self.durations.items()]
+
+        return dict((name, {
+            'calls': calls,
+            'slow_calls': slow_calls,
+            'p50': percentile(durations, 0.5),
+            'p90': percentile(durations, 0.9),
+            'p99': percentile(durations, 0.99),
+            'max': durations[-1]
+        }) for name, durations, calls, slow_calls in items)
+
+    def reset(self):
+        """
+        Forgets recorded calls
+        """
+        with self.lock:
+            self.durations.clear()
+            self.calls.clear()
+            self.slow_calls.clear()
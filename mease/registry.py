@@ -1,42 +1,140 @@
 # -*- coding: utf-8 -*-
 import re
-import json
-
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from twisted.python.threadable import isInIOThread
+
+from .coroutines import iscoroutine
+from .coroutines import run_coroutine
+from .coroutines import wait_coroutine
+from .backends.base import NODE_KEY
 from .decorators import method_decorator
+from .executors import ReactorExecutor
 from .messages import ON_SEND
+from .messages import ON_CLIENT_SEND
+from .messages import MESSAGES_NAMES
+from .metrics import MeaseMetrics
+from .tracing import MessageTracer
+from .serializers import json_loads
 
 __all__ = ('Mease',)
 
+# Backreferences and conditional groups, renumbered when patterns are combined
+GROUP_REFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
 
 class Mease(object):
     """
     Registry for mease callbacks
     """
-    def __init__(self, backend_class, backend_settings={}):
+    def __init__(self, backend_class, backend_settings={}, executor=None,
+                 metrics=None, profiler=None, tracer=None):
         """
         Inits a registry
+        `executor` runs callbacks of incoming messages (defaults to the reactor thread pool)
+        `metrics` holds mease metrics (defaults to a new MeaseMetrics registry),
+        they are not recorded if False
+        `profiler` times each callback call when set
+        `tracer` samples messages logged on the hot path (defaults to DEBUG logging only)
         """
         # Backend
         self.backend = backend_class(backend_settings)
 
-        self.publisher = self.backend.get_publisher()
-        self.publisher.connect()
+        # The publisher connects on first use, so that a workers supervisor never connects
+        self._publisher = self.backend.get_publisher()
+        self._publisher_connected = False
+        self._publisher_lock = Lock()
 
         self.subscriber = self.backend.get_subscriber()
 
+        # Clients directory
+        self.directory = self.backend.get_directory()
+
+        # Callbacks executor
+        self.executor = executor or ReactorExecutor()
+
+        # Metrics
+        if metrics is None:
+            metrics = MeaseMetrics()
+        elif metrics is False:
+            metrics = MeaseMetrics(enabled=False)
+        self.metrics = metrics
+
+        # Callbacks profiler
+        self.profiler = profiler
+        if self.profiler is not None:
+            self.profiler.counter = self.metrics.slow_callbacks
+
+        # Hot path messages logging
+        self.tracer = tracer or MessageTracer()
+
+        # Websocket server factory, set when the server runs
+        self.factory = None
+
         # Callbacks
         self.openers = []
         self.closers = []
         self.receivers = []
         self.senders = []
 
+        # Senders routing table
+        self.routes = {}
+        self.global_senders = []
+        self.regex_senders = []
+        self.routing_re = None
+
+        # Senders matching a routing key, least recently used first
+        self.routing_cache = OrderedDict()
+        self.routing_cache_size = 1024
+        self.routing_cache_lock = Lock()
+
+    @property
+    def publisher(self):
+        """
+        Backend publisher, connected on first use
+        """
+        if not self._publisher_connected:
+            with self._publisher_lock:
+                if not self._publisher_connected:
+                    self._publisher.connect()
+                    self._publisher_connected = True
+
+        return self._publisher
+
+    @publisher.setter
+    def publisher(self, value):
+        self._publisher = value
+        self._publisher_connected = True
+
+    def _get_registry_functions(self, registry):
+        """
+        Returns functions names list for a registry
+        """
+        return [
+            f.__name__ if not isinstance(f, tuple) else f[0].__name__
+            for f in getattr(self, registry, [])]
+
     def _get_registry_names(self, registry):
         """
         Returns functions names for a registry
         """
-        return ', '.join(
-            f.__name__ if not isinstance(f, tuple) else f[0].__name__
-            for f in getattr(self, registry, []))
+        return ', '.join(self._get_registry_functions(registry))
+
+    def get_profile(self):
+        """
+        Returns callbacks profiler statistics by registry
+        """
+        if self.profiler is None:
+            return {}
+
+        stats = self.profiler.stats()
+
+        return dict(
+            (registry, dict(
+                (name, stats[name])
+                for name in self._get_registry_functions(registry) if name in stats))
+            for registry in ('openers', 'closers', 'receivers', 'senders'))
 
     # -- Registers
 
@@ -75,37 +173,186 @@ class Mease(object):
             routing_re[:] = [re.compile(r) for r in routing_re]
 
         self.senders.append((func, routing, routing_re))
+        self.add_route(len(self.senders) - 1, func, routing, routing_re)
+
+    def add_route(self, index, func, routing, routing_re):
+        """
+        Adds a sender function to the routing table
+        """
+        if routing is None and routing_re is None:
+            self.global_senders.append((index, func))
+
+        for key in routing or []:
+            self.routes.setdefault(key, []).append((index, func))
+
+        if routing_re:
+            self.regex_senders.append((index, func, routing_re))
+            self.routing_re = self.get_routing_re()
+
+        with self.routing_cache_lock:
+            self.routing_cache.clear()
+
+    def get_routing_re(self):
+        """
+        Returns a single alternation regex used to skip regex senders at once,
+        or None if patterns can't be combined without changing their meaning
+        """
+        patterns = [r for _, _, routings_re in self.regex_senders for r in routings_re]
+        default_flags = re.compile('').flags
+
+        for r in patterns:
+            if r.flags != default_flags or GROUP_REFERENCE_RE.search(r.pattern):
+                return None
+
+        try:
+            return re.compile('|'.join(
+                '(?:{pattern})'.format(pattern=r.pattern) for r in patterns))
+        except re.error:
+            return None
+
+    def get_senders(self, routing):
+        """
+        Returns sender functions matching a routing key, in registration order
+        """
+        if routing is None:
+            return [func for func, _, _ in self.senders]
+
+        with self.routing_cache_lock:
+            senders = self.routing_cache.pop(routing, None)
+            if senders is not None:
+                self.routing_cache[routing] = senders
+                return senders
+
+        matches = dict(self.global_senders)
+        matches.update(self.routes.get(routing, []))
+
+        if self.regex_senders and (
+                self.routing_re is None or self.routing_re.match(routing)):
+            matches.update(
+                (index, func) for index, func, routings_re in self.regex_senders
+                if any(r.match(routing) for r in routings_re))
+
+        senders = [matches[index] for index in sorted(matches)]
+
+        with self.routing_cache_lock:
+            self.routing_cache[routing] = senders
+            if len(self.routing_cache) > self.routing_cache_size:
+                self.routing_cache.popitem(last=False)
+
+        return senders
 
     # -- Callers
 
+    def call(self, func, *args, **kwargs):
+        """
+        Calls a callback
+        Coroutine callbacks are scheduled on the asyncio loop and their future is returned
+        With an ordered executor, lanes wait for the future before running the next callback
+        """
+        metrics = self.metrics if self.metrics.enabled else None
+        profiler = self.profiler
+
+        if metrics is None and profiler is None:
+            result = func(*args, **kwargs)
+
+            if iscoroutine(result):
+                return self.wait_ordered(run_coroutine(result))
+
+            return result
+
+        name = func.__name__
+        start = time()
+        result = None
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            if metrics is not None:
+                metrics.callback_errors.inc(labels=(name,))
+            raise
+        finally:
+            duration = time() - start
+            coroutine = iscoroutine(result)
+
+            # Coroutine callbacks are recorded when their future is done
+            if not coroutine:
+                if metrics is not None:
+                    metrics.callback_latency.observe(duration, labels=(name,))
+
+                if profiler is not None:
+                    profiler.record(name, duration)
+
+        if coroutine:
+            future = run_coroutine(result)
+
+            if metrics is not None:
+                self.record_future(name, start, future)
+
+            if profiler is not None:
+                profiler.record_future(name, start, future)
+
+            return self.wait_ordered(future)
+
+        return result
+
+    def record_future(self, name, start, future):
+        """
+        Records the duration and error of a coroutine callback when its future is done
+        """
+        metrics = self.metrics
+
+        def done(future):
+            metrics.callback_latency.observe(time() - start, labels=(name,))
+
+            if not future.cancelled() and future.exception() is not None:
+                metrics.callback_errors.inc(labels=(name,))
+
+        future.add_done_callback(done)
+
+    def wait_ordered(self, future):
+        """
+        Waits for a coroutine future when callbacks run in order
+        The reactor thread never waits, as it may run the asyncio loop
+        """
+        if self.executor.ordered and not isInIOThread():
+            wait_coroutine(future)
+
+        return future
+
     def call_openers(self, client, clients_list):
         """
         Calls openers callbacks
         """
         for func in self.openers:
-            func(client, clients_list)
+            self.call(func, client, clients_list)
 
     def call_closers(self, client, clients_list):
         """
         Calls closers callbacks
         """
         for func in self.closers:
-            func(client, clients_list)
+            self.call(func, client, clients_list)
 
     def call_receivers(self, client, clients_list, message):
         """
         Calls receivers callbacks
         """
-        # Try to parse JSON
-        try:
-            json_message = json.loads(message)
-        except ValueError:
-            json_message = None
+        json_message = None
+        json_parsed = False
 
         for func, to_json in self.receivers:
 
             # Check if json version is available
             if to_json:
+
+                # Parse JSON once, for the first JSON receiver
+                if not json_parsed:
+                    json_parsed = True
+                    try:
+                        json_message = json_loads(message)
+                    except ValueError:
+                        pass
+
                 if json_message is None:
                     continue
                 msg = json_message
@@ -113,32 +360,14 @@ class Mease(object):
                 msg = message
 
             # Call callback
-            func(client, clients_list, msg)
+            self.call(func, client, clients_list, msg)
 
     def call_senders(self, routing, clients_list, *args, **kwargs):
         """
         Calls senders callbacks
         """
-        for func, routings, routings_re in self.senders:
-            call_callback = False
-
-            # Message is published globally
-            if routing is None or (routings is None and routings_re is None):
-                call_callback = True
-
-            # Message is not published globally
-            else:
-
-                # Message is catched by a string routing key
-                if routings and routing in routings:
-                    call_callback = True
-
-                # Message is catched by a regex routing key
-                if routings_re and any(r.match(routing) for r in routings_re):
-                    call_callback = True
-
-            if call_callback:
-                func(routing, clients_list, *args, **kwargs)
+        for func in self.get_senders(routing):
+            self.call(func, routing, clients_list, *args, **kwargs)
 
     # -- Publisher
 
@@ -147,17 +376,61 @@ class Mease(object):
         """
         Publishes a message
         """
+        if not self.metrics.enabled:
+            self.publisher.publish(
+                message_type, client_id, client_storage, *args, **kwargs)
+            return
+
+        start = time()
+
         self.publisher.publish(
             message_type, client_id, client_storage, *args, **kwargs)
 
+        self.metrics.published.inc(labels=(MESSAGES_NAMES[message_type],))
+        self.metrics.publish_latency.observe(time() - start)
+
+    def send_to_client(self, client_id, payload):
+        """
+        Sends a payload to a client
+        The message is only published to the node of the client when it is
+        known by the clients directory, and to every node otherwise
+        """
+        if self.factory is not None:
+            client = self.factory.get_client(client_id)
+            if client is not None:
+                client.send(payload)
+                return
+
+        node_id = self.directory.lookup(client_id) if self.directory else None
+
+        self.publisher.publish(
+            ON_CLIENT_SEND, client_id, None, payload=payload, **{NODE_KEY: node_id})
+
     # -- Websocket
 
-    def run_websocket_server(self, host='localhost', port=9090, debug=False):
+    def run_websocket_server(self, host='localhost', port=9090, debug=False,
+                             local_dispatch=False, storage_delta=False,
+                             workers=1, reuse_port=False, metrics_port=None):
         """
         Runs websocket server
+        If `local_dispatch` is True, open/close/receive events of connected
+        clients are dispatched in-process instead of going through the backend
+        If `storage_delta` is True, only changed client storage keys are published
+        If `workers` is greater than 1, runs a supervisor with `workers` server processes
+        If `reuse_port` is True, servers listen with SO_REUSEPORT
+        If `metrics_port` is set, metrics are served over HTTP on this port
+        (incremented by the worker index with multiple workers)
         """
+        from .workers import Supervisor
+        from .workers import is_worker
+
+        if workers > 1 and not is_worker():
+            Supervisor(host, port, workers, reuse_port=reuse_port).run()
+            return
+
         from .server import MeaseWebSocketServerFactory
 
         websocket_factory = MeaseWebSocketServerFactory(
-            mease=self, host=host, port=port, debug=debug)
-        websocket_factory.run_server()
+            mease=self, host=host, port=port, debug=debug,
+            local_dispatch=local_dispatch, storage_delta=storage_delta)
+        websocket_factory.run_server(reuse_port=reuse_port, metrics_port=metrics_port)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+
+# Use a faster JSON decoder when available
+try:
+    from orjson import loads as fast_json_loads
+except ImportError:
+    try:
+        from ujson import loads as fast_json_loads
+    except ImportError:
+        fast_json_loads = None
+
+__all__ = (
+    'fast_json_loads', 'json_loads', 'SerializationError', 'LegacySerializer', 'PickleSerializer',
+    'JSONSerializer', 'MsgpackSerializer', 'SERIALIZERS', 'Envelope')
+
+
+def json_loads(data):
+    """
+    Parses JSON with the fast decoder
+    Documents it rejects are parsed again with the json module only if they may
+    hold values it doesn't support (NaN, Infinity or escaped surrogates),
+    so that invalid JSON isn't parsed twice
+    """
+    try:
+        return fast_json_loads(data)
+    except ValueError:
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        if 'NaN' in data or 'Infinity' in data or '\\u' in data:
+            return json.loads(data)
+        raise
+
+
+if fast_json_loads is None:
+    json_loads = json.loads
+
+
+class SerializationError(Exception):
+    """
+    Raised when a message can't be packed or unpacked
+    """
+    pass
+
+
+class BaseSerializer(object):
+    """
+    Base serializer that converts messages to bytes
+    """
+    name = None
+    id = None
+
+    def dumps(self, obj):
+        """
+        Serializes an object
+        """
+        raise NotImplementedError(
+            "You need to implement the `dumps` method for your serializer")
+
+    def loads(self, data):
+        """
+        Deserializes an object
+        """
+        raise NotImplementedError(
+            "You need to implement the `loads` method for your serializer")
+
+
+class LegacySerializer(BaseSerializer):
+    """
+    Pickle protocol 2 without envelope, as sent by previous mease versions
+    """
+    name = 'legacy'
+    id = 0
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=2)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class PickleSerializer(BaseSerializer):
+    """
+    Pickle serializer using the highest available protocol
+    """
+    name = 'pickle'
+    id = 1
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(BaseSerializer):
+    """
+    JSON serializer
+    Tuples are received as lists
+    """
+    name = 'json'
+    id = 2
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json_loads(data.decode('utf-8'))
+
+
+class MsgpackSerializer(BaseSerializer):
+    """
+    Msgpack serializer
+    Tuples are received as lists
+    """
+    name = 'msgpack'
+    id = 3
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise SerializationError("Missing serializer dependency (msgpack)")
+
+        self.msgpack = msgpack
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = dict((s.name, s) for s in (
+    LegacySerializer, PickleSerializer, JSONSerializer, MsgpackSerializer))
+
+
+class Envelope(object):
+    """
+    Packs messages with a header holding the envelope version and the
+    serializer id, so that nodes using different serializers or versions
+    can read each other's messages
+
+    Header : MAGIC (2 bytes) | VERSION (1 byte) | serializer id (1 byte)
+    Messages without header are read as legacy pickle messages
+    Messages are (message type, client id, client storage, args, kwargs) sequences
+    """
+    MAGIC = b'MS'
+    VERSION = 1
+
+    def __init__(self, serializer='pickle', accept=None):
+        if accept is None:
+            accept = [serializer]
+
+        # Pickle and legacy messages are the same format with a different header
+        if 'pickle' in accept or 'legacy' in accept:
+            accept = set(accept) | set(['pickle', 'legacy'])
+
+        self.serializer = self.get_serializer(serializer)
+        self.header = self.MAGIC + bytearray([self.VERSION, self.serializer.id])
+
+        self.serializers = {}
+        for name in accept:
+            s = self.get_serializer(name)
+            self.serializers[s.id] = s
+
+    def get_serializer(self, name):
+        """
+        Returns a serializer instance from its name
+        """
+        try:
+            return SERIALIZERS[name]()
+        except KeyError:
+            raise SerializationError("Unknown serializer : {name}".format(name=name))
+
+    def pack(self, obj):
+        """
+        Serializes an object and prepends the envelope header
+        """
+        if self.serializer.id == LegacySerializer.id:
+            return self.serializer.dumps(obj)
+
+        return bytes(self.header) + self.serializer.dumps(obj)
+
+    def unpack(self, data):
+        """
+        Reads the envelope header and deserializes a message
+        Raises SerializationError for any message that can't be dispatched
+        """
+        if data[:2] != self.MAGIC:
+            serializer_id = LegacySerializer.id
+        else:
+            if len(data) < 4:
+                raise SerializationError("Truncated envelope header")
+
+            version, serializer_id = bytearray(data[2:4])
+            data = data[4:]
+
+            if version > self.VERSION:
+                raise SerializationError(
+                    "Unsupported envelope version : {version}".format(version=version))
+
+        serializer = self.serializers.get(serializer_id)
+
+        if serializer is None:
+            raise SerializationError(
+                "Serializer not accepted : {id}".format(id=serializer_id))
+
+        try:
+            message = serializer.loads(data)
+        except Exception as e:
+            raise SerializationError(
+                "Unable to deserialize message : {error}".format(error=e))
+
+        if not (isinstance(message, (list, tuple)) and len(message) == 5 and
+                isinstance(message[3], (list, tuple)) and isinstance(message[4], dict)):
+            raise SerializationError("Invalid message : {message!r}".format(
+                message=message)[:200])
+
+        return message
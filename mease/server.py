@@ -1,28 +1,88 @@
 # -*- coding: utf-8 -*-
+import os
 import json
+from base64 import urlsafe_b64encode
+from collections import deque
+from copy import deepcopy
+from itertools import count
+from threading import Lock
+from time import time
 from autobahn.twisted.websocket import WebSocketServerProtocol
 from autobahn.twisted.websocket import WebSocketServerFactory
-from uuid import uuid1
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python.threadable import isInIOThread
+from twisted.web.server import Site
 
 from . import logger
+from .backends.base import PublisherOverflow
+from .backends.base import PublisherDisconnected
+from .executors import ThreadPoolExecutor
 from .messages import ON_OPEN
 from .messages import ON_CLOSE
 from .messages import ON_RECEIVE
+from .messages import MESSAGES_NAMES
+from .metrics import MetricsResource
+from .workers import get_worker_index
+from .workers import get_worker_socket
+from .workers import listening_socket
 
 __all__ = ('MeaseWebSocketServerProtocol', 'MeaseWebSocketServerFactory')
 
+# Client ids are made of a random 96 bits process prefix and a connection
+# counter, so that they are unique across nodes like uuids while being shorter
+CLIENT_ID_PREFIX = urlsafe_b64encode(os.urandom(12)).decode('ascii')
+client_ids_counter = count(1)
+
+
+def new_client_id():
+    """
+    Returns a new client id
+    """
+    return '{prefix}{count:x}'.format(
+        prefix=CLIENT_ID_PREFIX, count=next(client_ids_counter))
+
+
+def encode_payload(payload):
+    """
+    Encodes a payload, dumping lists and dicts to JSON
+    """
+    if isinstance(payload, (list, dict)):
+        payload = json.dumps(payload)
+
+    return payload.encode()
+
 
 class MeaseWebSocketServerProtocol(WebSocketServerProtocol):
 
+    # Storage dicts are only allocated when used, as most connections are idle
+    _storage = None
+    _sent_storage = None
+
+    @property
+    def storage(self):
+        """
+        Client storage, created on first use
+        """
+        storage = self._storage
+        if storage is None:
+            # Callbacks of a client may run in several threads at once
+            storage = self.__dict__.setdefault('_storage', {})
+        return storage
+
+    @storage.setter
+    def storage(self, value):
+        self._storage = value
+
     def onConnect(self, request):
         """
         Called when a client opens a websocket connection
         """
-        logger.debug("Connection opened ({peer})".format(peer=self.peer))
+        log = self.factory.mease.tracer.sample()
+        if log is not None:
+            log("Connection opened ({peer})".format(peer=self.peer))
 
-        self.storage = {}
-        self._client_id = str(uuid1())
+        self._client_id = new_client_id()
 
     def onOpen(self):
         """
@@ -31,18 +91,18 @@ class MeaseWebSocketServerProtocol(WebSocketServerProtocol):
         self.factory.add_client(self)
 
         # Publish ON_OPEN message
-        self.factory.mease.publisher.publish(
-            message_type=ON_OPEN, client_id=self._client_id, client_storage=self.storage)
+        self.publish(ON_OPEN)
 
     def onClose(self, was_clean, code, reason):
         """
         Called when a client closes a websocket connection
         """
-        logger.debug("Connection closed ({peer})".format(peer=self.peer))
+        log = self.factory.mease.tracer.sample()
+        if log is not None:
+            log("Connection closed ({peer})".format(peer=self.peer))
 
         # Publish ON_CLOSE message
-        self.factory.mease.publisher.publish(
-            message_type=ON_CLOSE, client_id=self._client_id, client_storage=self.storage)
+        self.publish(ON_CLOSE)
 
         self.factory.remove_client(self)
 
@@ -50,57 +110,183 @@ class MeaseWebSocketServerProtocol(WebSocketServerProtocol):
         """
         Called when a client sends a message
         """
+        metrics = self.factory.mease.metrics
+        if metrics.enabled:
+            metrics.frames_in.inc()
+            metrics.bytes_in.inc(len(payload))
+
         if not is_binary:
             payload = payload.decode('utf-8')
 
-            logger.debug("Incoming message ({peer}) : {message}".format(
-                peer=self.peer, message=payload))
+            log = self.factory.mease.tracer.sample()
+            if log is not None:
+                log("Incoming message ({peer}) : {message}".format(
+                    peer=self.peer, message=payload))
 
             # Publish ON_RECEIVE message
-            self.factory.mease.publisher.publish(
-                message_type=ON_RECEIVE,
-                client_id=self._client_id,
-                client_storage=self.storage,
-                message=payload)
+            self.publish(ON_RECEIVE, message=payload)
+
+    def publish(self, message_type, **kwargs):
+        """
+        Publishes a client event on the backend, or dispatches it
+        in-process when the factory runs in local dispatch mode
+        """
+        if self.factory.local_dispatch:
+            self.factory.mease.subscriber.dispatch_message(
+                message_type, self._client_id, self._storage or {}, (), kwargs)
+        else:
+            client_storage = self._storage or {}
+
+            # Only send changed storage keys
+            if self.factory.storage_delta:
+                client_storage = None
+
+                delta = self.get_storage_delta()
+                if delta or message_type == ON_OPEN:
+                    kwargs['storage_delta'] = delta or {'changed': {}, 'removed': []}
+
+            metrics = self.factory.mease.metrics
+            start = time()
+
+            try:
+                self.factory.mease.publisher.publish(
+                    message_type=message_type,
+                    client_id=self._client_id,
+                    client_storage=client_storage,
+                    **kwargs)
+
+                if metrics.enabled:
+                    metrics.published.inc(labels=(MESSAGES_NAMES[message_type],))
+                    metrics.publish_latency.observe(time() - start)
+            except PublisherOverflow:
+                logger.warning("Publisher overflow, dropping connection ({peer})".format(
+                    peer=self.peer))
+
+                self.dropConnection(abort=True)
+            except PublisherDisconnected:
+                logger.warning("Publisher disconnected, message lost ({peer})".format(
+                    peer=self.peer))
+
+    def join(self, group):
+        """
+        Joins a group
+        """
+        self.factory.join_group(self, group)
+
+    def leave(self, group):
+        """
+        Leaves a group
+        """
+        self.factory.leave_group(self, group)
+
+    def get_storage_delta(self):
+        """
+        Returns storage keys changed or removed since the last call, or None
+        """
+        storage = dict(self._storage or {})
+        sent_storage = self._sent_storage or {}
+
+        changed = dict(
+            (k, v) for k, v in storage.items()
+            if k not in sent_storage or sent_storage[k] != v)
+        removed = [k for k in sent_storage if k not in storage]
+
+        if not changed and not removed:
+            return None
+
+        self._sent_storage = deepcopy(storage) or None
+
+        return {'changed': changed, 'removed': removed}
 
     def sendMessage(self, payload, *args, **kwargs):
         """
         Logs message
         """
-        logger.debug("Outgoing message for ({peer}) : {message}".format(
-            peer=self.peer, message=payload))
+        log = self.factory.mease.tracer.sample()
+        if log is not None:
+            log("Outgoing message for ({peer}) : {message}".format(
+                peer=self.peer, message=payload))
+
+        metrics = self.factory.mease.metrics
+        if metrics.enabled:
+            metrics.frames_out.inc()
+            metrics.bytes_out.inc(len(payload))
 
         WebSocketServerProtocol.sendMessage(self, payload, *args, **kwargs)
 
     def send(self, payload, *args, **kwargs):
         """
         Alias for WebSocketServerProtocol `sendMessage` method
+        Can be called from any thread
         """
-        if isinstance(payload, (list, dict)):
-            payload = json.dumps(payload)
+        self.factory.call_in_reactor(
+            self.send_if_open, encode_payload(payload), *args, **kwargs)
 
-        self.sendMessage(payload.encode(), *args, **kwargs)
+    def send_if_open(self, payload, *args, **kwargs):
+        """
+        Sends a message if the connection is still open
+        """
+        if self.state == self.STATE_OPEN:
+            self.sendMessage(payload, *args, **kwargs)
 
 
 class MeaseWebSocketServerFactory(WebSocketServerFactory):
-    def __init__(self, mease, host, port, debug):
+    def __init__(self, mease, host, port, debug, local_dispatch=False,
+                 storage_delta=False):
         self.host = host
         self.port = port
+        self.local_dispatch = local_dispatch
+        self.storage_delta = storage_delta
 
         self.address = 'ws://{host}:{port}'.format(host=host, port=self.port)
         WebSocketServerFactory.__init__(self, self.address, debug=debug)
 
         self.storage = {}
         self.clients_list = set()
+        self.clients = {}
+
+        # Calls queued from other threads for the reactor thread
+        self.pending_calls = deque()
+        self.pending_calls_lock = Lock()
+        self.pending_calls_scheduled = False
+
+        # Group name -> clients and client id -> group names
+        self.groups = {}
+        self.client_groups = {}
 
         self.mease = mease
+        self.mease.factory = self
 
         # Connect to subscriber
         logger.debug("Connecting to backend ({backend_name})...".format(
             backend_name=self.mease.backend.name))
 
-        self.mease.subscriber.connect()
         self.mease.subscriber.factory = self
+        self.mease.subscriber.connect()
+
+        self.mease.executor.start()
+
+        # Metrics read when rendered
+        metrics = self.mease.metrics
+        metrics.connections.set_function(lambda: len(self.clients_list))
+        metrics.executor_queue_depth.set_function(
+            lambda: self.mease.executor.stats().get('queue_depth', 0))
+
+        publisher_stats = getattr(self.mease.publisher, 'stats', dict)
+        metrics.publisher_queue_depth.set_function(
+            lambda: publisher_stats().get('queue_depth', 0))
+
+        # Directory calls may wait on the network : they run in order
+        # in a dedicated thread, and the node is kept alive with a heartbeat
+        directory = self.mease.directory
+        if directory is not None:
+            self.directory_executor = ThreadPoolExecutor(size=1)
+            self.directory_executor.start()
+
+            if directory.heartbeat_interval:
+                self.heartbeat = LoopingCall(
+                    self.call_directory, directory.heartbeat, self.mease.backend.node_id)
+                self.heartbeat.start(directory.heartbeat_interval)
 
         # Log registered callbacks
         logger.debug("Registered callback functions :")
@@ -119,22 +305,214 @@ class MeaseWebSocketServerFactory(WebSocketServerFactory):
         Adds a client to the clients list
         """
         self.clients_list.add(client)
+        self.clients[client._client_id] = client
+
+        if self.mease.directory is not None:
+            self.call_directory(
+                self.mease.directory.register,
+                client._client_id, self.mease.backend.node_id)
 
     def remove_client(self, client):
         """
         Removes a client from the client list
         """
         self.clients_list.discard(client)
+        self.clients.pop(client._client_id, None)
+
+        if self.mease.directory is not None:
+            self.call_directory(
+                self.mease.directory.unregister,
+                client._client_id, self.mease.backend.node_id)
 
-    def run_server(self):
+        for group in list(self.client_groups.get(client._client_id, ())):
+            self.remove_from_group(client, group)
+
+    def call_directory(self, method, *args):
+        """
+        Queues a clients directory call
+        """
+        self.directory_executor.submit(self.run_directory_call, method, *args)
+
+    def run_directory_call(self, method, *args):
+        """
+        Runs a clients directory call, logging errors
+        """
+        try:
+            method(*args)
+        except Exception:
+            logger.exception("Clients directory error")
+
+    def get_client(self, client_id):
+        """
+        Returns a connected client from its id or None
+        """
+        return self.clients.get(client_id)
+
+    def join_group(self, client, group):
+        """
+        Adds a connected client to a group
+        Groups are only updated in the reactor thread, like the clients list
+        """
+        self.call_in_reactor(self.add_to_group, client, group)
+
+    def leave_group(self, client, group):
+        """
+        Removes a client from a group
+        """
+        self.call_in_reactor(self.remove_from_group, client, group)
+
+    def add_to_group(self, client, group):
+        """
+        Adds a connected client to a group in the reactor thread
+        """
+        if client._client_id not in self.clients:
+            return
+
+        self.groups.setdefault(group, set()).add(client)
+        self.client_groups.setdefault(client._client_id, set()).add(group)
+
+    def remove_from_group(self, client, group):
+        """
+        Removes a client from a group in the reactor thread
+        """
+        clients = self.groups.get(group)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.groups[group]
+
+        groups = self.client_groups.get(client._client_id)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.client_groups[client._client_id]
+
+    def get_group(self, group):
+        """
+        Returns clients of a group
+        """
+        return set(self.groups.get(group, ()))
+
+    def broadcast_to_group(self, group, payload):
+        """
+        Sends a payload to clients of a group
+        Members are read in the reactor thread, after pending group changes
+        """
+        prepared, size = self.prepare_payload(payload)
+        self.call_in_reactor(self.send_prepared_to_group, prepared, group, size)
+
+    def broadcast(self, payload, clients=None):
+        """
+        Sends a payload to clients (defaults to all connected clients)
+        The payload is serialized and framed once for every client
+        """
+        if clients is None:
+            clients = self.clients_list
+
+        prepared, size = self.prepare_payload(payload)
+        self.call_in_reactor(self.send_prepared, prepared, clients, size)
+
+    def prepare_payload(self, payload):
+        """
+        Returns a prepared message of a payload and the payload size
+        """
+        data = encode_payload(payload)
+        prepared = self.prepareMessage(data)
+
+        log = self.mease.tracer.sample()
+        if log is not None:
+            log("Outgoing broadcast message : {message}".format(message=payload))
+
+        return prepared, len(data)
+
+    def send_prepared_to_group(self, prepared, group, size=0):
+        """
+        Sends a prepared message to open clients of a group
+        """
+        self.send_prepared(prepared, self.groups.get(group, ()), size)
+
+    def send_prepared(self, prepared, clients, size=0):
+        """
+        Sends a prepared message to open clients
+        """
+        sent = 0
+
+        for client in list(clients):
+            if client.state == client.STATE_OPEN:
+                client.sendPreparedMessage(prepared)
+                sent += 1
+
+        metrics = self.mease.metrics
+        if metrics.enabled:
+            metrics.frames_out.inc(sent)
+            metrics.bytes_out.inc(sent * size)
+
+    def call_in_reactor(self, func, *args, **kwargs):
+        """
+        Calls a function in the reactor thread
+        Calls made from other threads are queued and run in batches,
+        with a single reactor wake up per batch
+        """
+        if isInIOThread():
+            func(*args, **kwargs)
+            return
+
+        with self.pending_calls_lock:
+            self.pending_calls.append((func, args, kwargs))
+
+            if self.pending_calls_scheduled:
+                return
+            self.pending_calls_scheduled = True
+
+        reactor.callFromThread(self.run_pending_calls)
+
+    def run_pending_calls(self):
+        """
+        Runs calls queued from other threads
+        """
+        with self.pending_calls_lock:
+            calls, self.pending_calls = self.pending_calls, deque()
+            self.pending_calls_scheduled = False
+
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Error in reactor call")
+
+    def run_server(self, reuse_port=False, metrics_port=None):
         """
         Runs the WebSocket server
+        Uses the listening socket of the supervisor in worker processes
         """
         self.protocol = MeaseWebSocketServerProtocol
 
-        reactor.listenTCP(port=self.port, factory=self, interface=self.host)
+        worker_socket = get_worker_socket()
+
+        if worker_socket is not None:
+            fileno, family = worker_socket
+            reactor.adoptStreamPort(fileno, family, self)
+
+        elif reuse_port:
+            sock = listening_socket(self.host, self.port, reuse_port=True)
+            reactor.adoptStreamPort(sock.fileno(), sock.family, self)
+            sock.close()
+
+        else:
+            reactor.listenTCP(port=self.port, factory=self, interface=self.host)
 
         logger.info("Websocket server listening on {address}".format(
             address=self.address))
 
+        if metrics_port is not None:
+            metrics_port += get_worker_index()
+
+            reactor.listenTCP(
+                port=metrics_port,
+                factory=Site(MetricsResource(self.mease.metrics)),
+                interface=self.host)
+
+            logger.info("Metrics served on http://{host}:{port}/".format(
+                host=self.host, port=metrics_port))
+
         reactor.run()
@@ -1,8 +1,72 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import types
 import json
+import time
 import unittest
+from collections import deque
+from threading import Event
+from threading import Lock
+from threading import Thread
+from twisted.internet.defer import DeferredList
 from .registry import Mease
+from .directory import MemoryDirectory
+from .directory import RedisDirectory
+from .executors import InlineExecutor
+from .executors import ThreadPoolExecutor
+from .executors import OrderedExecutor
+from .executors import SHED_OLDEST
+from .metrics import MetricsRegistry
+from .profiling import CallbackProfiler
+from .tracing import MessageTracer
+from .workers import WORKER_ENV
+from .workers import WORKER_SOCKET_ENV
+from .workers import get_worker_command
+from .workers import get_worker_index
+from .workers import get_worker_socket
+from .workers import listening_socket
+from .serializers import Envelope
+from .serializers import SerializationError
+from .serializers import json_loads
+from .messages import ON_OPEN
+from .messages import ON_CLOSE
+from .messages import ON_RECEIVE
+from .messages import ON_SEND
+from .messages import ON_CLIENT_SEND
+from .backends.base import PublisherOverflow
+from .backends.base import PublisherDisconnected
+from .backends.resilient import ResilientPublisher
+from .backends.resp import RedisError
+from .backends.resp import encode_command
+from .backends.resp import parse_replies
 from .backends.test import TestBackend
+from .backends.test import TestPublisher
+from .backends.test import TestSubscriber
+from .backends.threaded import ThreadedPublisher
+from .backends.threaded import OVERFLOW_DISCONNECT
+
+try:
+    import redis
+    from .backends.redis import RedisPublisher
+    from .backends.redis import RedisSubscriber
+    from .backends.redis import RedisStreamsPublisher
+    from .backends.redis import RedisStreamsSubscriber
+except ImportError:
+    redis = None
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import kombu
+    from .backends.rabbitmq import RabbitMQPublisher
+    from .backends.rabbitmq import RabbitMQSubscriber
+except ImportError:
+    kombu = None
 
 
 class MeaseTestCase(unittest.TestCase):
@@ -104,6 +168,22 @@ class MeaseTestCase(unittest.TestCase):
         self.assertEqual(message, self.ret.raw_message)
         self.assertListEqual(clients_list, self.ret.raw_clients_list)
 
+    def test_receiver_json_compatibility(self):
+        """
+        Tests that JSON receivers get messages only parsed by the json module
+        """
+        messages = []
+        self.mease.receiver(lambda client, clients_list, message: messages.append(message),
+                            json=True)
+
+        self.mease.call_receivers('a', [], '{"value": NaN, "text": "\\ud800"}')
+        self.mease.call_receivers('a', [], '{"value": Infinity')
+
+        self.assertEqual(1, len(messages))
+        self.assertNotEqual(messages[0]['value'], messages[0]['value'])
+        self.assertEqual(u'\ud800', messages[0]['text'])
+        self.assertRaises(ValueError, json_loads, 'Hello world !')
+
     def test_sender(self):
         """
         Tests senders callbacks
@@ -224,6 +304,1293 @@ class MeaseTestCase(unittest.TestCase):
         self.assertFalse(hasattr(self.ret, 'third_second_routing'))
         self.assertFalse(hasattr(self.ret, 'third_message'))
 
+    def test_regex_sender_flags(self):
+        """
+        Tests that regex senders with flags or backreferences still match
+        """
+        def first_sender_func(routing, message):
+            pass
+
+        def second_sender_func(routing, message):
+            pass
+
+        def third_sender_func(routing, message):
+            pass
+
+        self.mease.sender(first_sender_func, routing_re=re.compile('chat', re.I))
+        self.assertEqual([first_sender_func], self.mease.get_senders('CHAT'))
+
+        mease = Mease(TestBackend)
+        mease.sender(second_sender_func, routing_re=r'(x)\1')
+        mease.sender(third_sender_func, routing_re=r'(y)\1')
+
+        self.assertEqual([third_sender_func], mease.get_senders('yy'))
+        self.assertEqual([second_sender_func], mease.get_senders('xx'))
+        self.assertEqual([], mease.get_senders('xy'))
+
+    def test_senders_order(self):
+        """
+        Tests that matching senders are called once, in registration order
+        """
+        def first_sender_func(routing, message):
+            pass
+
+        def second_sender_func(routing, message):
+            pass
+
+        def third_sender_func(routing, message):
+            pass
+
+        def fourth_sender_func(routing, message):
+            pass
+
+        self.mease.sender(first_sender_func, routing='mease_test', routing_re=r'mease_.*')
+        self.mease.sender(second_sender_func)
+        self.mease.sender(third_sender_func, routing_re=[r'(nope)', r'mease_(\w+)'])
+        self.mease.sender(fourth_sender_func, routing='mease_test')
+
+        for _ in range(2):
+            self.assertEqual(
+                [first_sender_func, second_sender_func, third_sender_func,
+                 fourth_sender_func],
+                self.mease.get_senders('mease_test'))
+
+        self.assertEqual(
+            [first_sender_func, second_sender_func, third_sender_func],
+            self.mease.get_senders('mease_other'))
+
+        self.assertEqual([second_sender_func], self.mease.get_senders('other'))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "async def requires Python 3.5")
+    def test_coroutine_opener(self):
+        """
+        Tests that coroutine callbacks are run on the asyncio loop
+        """
+        namespace = {}
+        exec(
+            "async def opener_func(client, clients_list):\n"
+            "    return client", namespace)
+
+        future = self.mease.call(namespace['opener_func'], 'a', [])
+
+        self.assertEqual('a', future.result(timeout=1))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "async def requires Python 3.5")
+    def test_coroutine_metrics(self):
+        """
+        Tests that coroutine callbacks are timed until they are done
+        """
+        namespace = {}
+        exec(
+            "import asyncio\n"
+            "async def opener_func(client, clients_list):\n"
+            "    await asyncio.sleep(0.01)\n"
+            "async def closer_func(client, clients_list):\n"
+            "    raise ValueError", namespace)
+
+        self.mease.call(namespace['opener_func'], 'a', []).result(timeout=1)
+        future = self.mease.call(namespace['closer_func'], 'a', [])
+        self.assertRaises(ValueError, future.result, timeout=1)
+
+        # Done callbacks run in the loop thread after the future result is set
+        deadline = time.time() + 1
+        while 'closer_func' not in self.mease.metrics.render() and time.time() < deadline:
+            time.sleep(0.001)
+
+        output = self.mease.metrics.render()
+        self.assertIn(
+            'mease_callback_seconds_bucket{function="opener_func",le="0.005"} 0\n', output)
+        self.assertIn('mease_callback_seconds_count{function="opener_func"} 1\n', output)
+        self.assertIn('mease_callback_errors_total{function="closer_func"} 1\n', output)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "async def requires Python 3.5")
+    def test_coroutine_ordered(self):
+        """
+        Tests that ordered executor lanes wait for coroutine callbacks
+        """
+        results = []
+        namespace = {'results': results}
+        exec(
+            "import asyncio\n"
+            "async def receiver_func(client, clients_list, message):\n"
+            "    await asyncio.sleep(0.01 if message == 'first' else 0)\n"
+            "    results.append(message)", namespace)
+
+        mease = Mease(TestBackend, executor=OrderedExecutor(lanes=1))
+        mease.receiver(namespace['receiver_func'])
+        mease.executor.start()
+
+        mease.executor.submit_to('a', mease.call_receivers, 'a', [], 'first')
+        mease.executor.submit_to('a', mease.call_receivers, 'a', [], 'second')
+        mease.executor.stop()
+
+        self.assertEqual(['first', 'second'], results)
+
+    def test_lazy_publisher(self):
+        """
+        Tests that the publisher connects on first use
+        """
+        mease = Mease(TestBackend)
+        self.assertFalse(mease._publisher_connected)
+
+        mease.publish(routing='mease.test')
+        self.assertTrue(mease._publisher_connected)
+
+    def test_send_to_client(self):
+        """
+        Tests that client messages are published to the node of the client
+        """
+        mease = Mease(TestBackend, {'DIRECTORY': True})
+        mease.publisher = RecordingPublisher()
+
+        mease.directory.register('a', 'node')
+        mease.send_to_client('a', 'Hello')
+
+        mease.directory.unregister('a')
+        mease.send_to_client('a', 'World')
+
+        self.assertEqual([
+            (ON_CLIENT_SEND, 'a', None, (), {'payload': 'Hello', '_node': 'node'}),
+            (ON_CLIENT_SEND, 'a', None, (), {'payload': 'World', '_node': None})],
+            mease.publisher.messages)
+
+    def test_callback_metrics(self):
+        """
+        Tests that callbacks duration and errors are recorded
+        """
+        def opener_func(client, clients_list):
+            pass
+
+        def closer_func(client, clients_list):
+            raise ValueError
+
+        self.mease.opener(opener_func)
+        self.mease.closer(closer_func)
+
+        self.mease.call_openers('a', [])
+        self.assertRaises(ValueError, self.mease.call_closers, 'a', [])
+
+        output = self.mease.metrics.render()
+        self.assertIn('mease_callback_seconds_count{function="opener_func"} 1\n', output)
+        self.assertIn('mease_callback_seconds_count{function="closer_func"} 1\n', output)
+        self.assertIn('mease_callback_errors_total{function="closer_func"} 1\n', output)
+
+    def test_profiler(self):
+        """
+        Tests that callbacks are profiled by registry and slow calls counted
+        """
+        mease = Mease(TestBackend, profiler=CallbackProfiler(threshold=0.01))
+
+        def opener_func(client, clients_list):
+            pass
+
+        def receiver_func(client, clients_list, message):
+            time.sleep(0.02)
+
+        mease.opener(opener_func)
+        mease.receiver(receiver_func)
+
+        for _ in range(3):
+            mease.call_openers('a', [])
+        mease.call_receivers('a', [], 'Hello')
+
+        profile = mease.get_profile()
+
+        self.assertEqual(3, profile['openers']['opener_func']['calls'])
+        self.assertEqual(0, profile['openers']['opener_func']['slow_calls'])
+        self.assertEqual(1, profile['receivers']['receiver_func']['slow_calls'])
+        self.assertGreaterEqual(profile['receivers']['receiver_func']['p99'], 0.02)
+        self.assertEqual({}, profile['senders'])
+
+        self.assertIn(
+            'mease_slow_callbacks_total{function="receiver_func"} 1\n',
+            mease.metrics.render())
+
+
+class RecordingPublisher(TestPublisher):
+    def __init__(self, *args, **kwargs):
+        super(RecordingPublisher, self).__init__(*args, **kwargs)
+        self.messages = []
+
+    def publish(self, message_type, client_id, client_storage, *args, **kwargs):
+        self.messages.append((message_type, client_id, client_storage, args, kwargs))
+
+    def flush(self):
+        self.messages.append('flush')
+
+
+class ThreadedPublisherTestCase(unittest.TestCase):
+
+    def test_publish(self):
+        """
+        Tests that queued messages are published in order
+        """
+        publisher = ThreadedPublisher(RecordingPublisher())
+        publisher.connect()
+
+        storage = {'a': 1}
+        publisher.publish(ON_OPEN, 'id', storage)
+        publisher.publish(ON_SEND, None, None, routing='mease.test')
+        storage['a'] = 2
+
+        publisher.exit()
+
+        self.assertEqual(
+            [(ON_OPEN, 'id', {'a': 1}, (), {}),
+             (ON_SEND, None, None, (), {'routing': 'mease.test'})],
+            publisher.publisher.messages)
+        self.assertEqual(2, publisher.stats()['published'])
+
+    def test_flush(self):
+        """
+        Tests that the wrapped publisher is flushed after queued messages
+        """
+        publisher = ThreadedPublisher(RecordingPublisher())
+        publisher.connect()
+
+        publisher.publish(ON_SEND, None, None, routing='mease.test')
+        publisher.flush()
+        publisher.exit()
+
+        self.assertEqual(
+            [(ON_SEND, None, None, (), {'routing': 'mease.test'}), 'flush'],
+            publisher.publisher.messages)
+
+    def test_overflow(self):
+        """
+        Tests overflow policies
+        """
+        publisher = ThreadedPublisher(RecordingPublisher(), queue_size=1)
+        publisher.publish(ON_SEND)
+        publisher.publish(ON_SEND)
+
+        self.assertEqual(1, publisher.stats()['queue_depth'])
+        self.assertEqual(1, publisher.stats()['dropped'])
+
+        publisher = ThreadedPublisher(
+            RecordingPublisher(), queue_size=1, overflow=OVERFLOW_DISCONNECT)
+        publisher.publish(ON_SEND)
+
+        self.assertRaises(PublisherOverflow, publisher.publish, ON_SEND)
+
+
+class FlakyPublisher(RecordingPublisher):
+    def __init__(self, *args, **kwargs):
+        super(FlakyPublisher, self).__init__(*args, **kwargs)
+        self.down = False
+
+    def publish(self, *args, **kwargs):
+        if self.down:
+            raise PublisherDisconnected()
+        super(FlakyPublisher, self).publish(*args, **kwargs)
+
+
+class ResilientPublisherTestCase(unittest.TestCase):
+
+    def test_replay(self):
+        """
+        Tests that messages are buffered while disconnected and replayed in order
+        """
+        publisher = ResilientPublisher(FlakyPublisher(), buffer_size=2, delay=60)
+        publisher.connect()
+
+        publisher.publish(ON_SEND, None, None, i=0)
+
+        publisher.publisher.down = True
+        for i in range(1, 4):
+            publisher.publish(ON_SEND, None, None, i=i)
+
+        self.assertFalse(publisher.stats()['connected'])
+        self.assertEqual(2, publisher.stats()['buffered'])
+
+        publisher.publisher.down = False
+        publisher.reconnect()
+        publisher.publish(ON_SEND, None, None, i=4)
+
+        self.assertEqual(
+            [0, 2, 3, 4],
+            [kwargs['i'] for _, _, _, _, kwargs in publisher.publisher.messages])
+        self.assertEqual({
+            'connected': True, 'buffered': 0, 'published': 4, 'reconnects': 1,
+            'dropped': 1}, publisher.stats())
+
+        publisher.exit()
+
+    def test_replay_chunks(self):
+        """
+        Tests that messages published during a replay are buffered after replayed ones
+        """
+        publisher = ResilientPublisher(FlakyPublisher(), delay=60, replay_size=2)
+        publisher.connect()
+
+        publisher.publisher.down = True
+        for i in range(3):
+            publisher.publish(ON_SEND, None, None, i=i)
+
+        publisher.publisher.down = False
+        self.assertTrue(publisher.replay())
+        self.assertFalse(publisher.stats()['connected'])
+
+        publisher.publish(ON_SEND, None, None, i=3)
+        self.assertFalse(publisher.replay())
+
+        self.assertEqual(
+            [0, 1, 2, 3],
+            [kwargs['i'] for _, _, _, _, kwargs in publisher.publisher.messages])
+        self.assertTrue(publisher.stats()['connected'])
+
+        publisher.exit()
+
+
+class EnvelopeTestCase(unittest.TestCase):
+
+    message = (ON_SEND, None, None, (), {'routing': 'mease.test', 'message': 'Hello'})
+
+    def test_pack(self):
+        """
+        Tests packing and unpacking messages with each serializer
+        """
+        for serializer in ('legacy', 'pickle', 'json'):
+            envelope = Envelope(serializer=serializer)
+            message_type, client_id, client_storage, args, kwargs = envelope.unpack(
+                envelope.pack(self.message))
+
+            self.assertEqual(self.message[4], kwargs)
+            self.assertEqual(list(self.message[3]), list(args))
+
+    def test_accept(self):
+        """
+        Tests that only accepted serializers are unpacked
+        """
+        pickled = Envelope(serializer='pickle').pack(self.message)
+        legacy = Envelope(serializer='legacy').pack(self.message)
+
+        envelope = Envelope(serializer='json')
+        self.assertRaises(SerializationError, envelope.unpack, pickled)
+        self.assertRaises(SerializationError, envelope.unpack, legacy)
+
+        envelope = Envelope(serializer='json', accept=['json', 'pickle'])
+        self.assertEqual(self.message, envelope.unpack(pickled))
+        self.assertEqual(self.message, envelope.unpack(legacy))
+
+    def test_invalid(self):
+        """
+        Tests that truncated headers and invalid messages are rejected
+        """
+        envelope = Envelope(serializer='json')
+
+        for data in (b'MS', b'MS\x01', b'MS\x01\x02[1,2]', b'MS\x01\x02{}',
+                     b'MS\x01\x02[1,null,null,[],[]]', b'MS\x01\x02nope'):
+            self.assertRaises(SerializationError, envelope.unpack, data)
+
+    def test_handle_invalid(self):
+        """
+        Tests that subscribers drop invalid messages
+        """
+        subscriber = TestSubscriber(envelope=Envelope(serializer='json'))
+        subscriber.handle_message(b'MS\x01')
+        subscriber.handle_message(b'MS\x01\x02[1,2]')
+        subscriber.handle_message(b'MS\x01\x02[42,null,null,[],{}]')
+
+
+class SubscriberTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subscriber = TestSubscriber()
+
+    def test_remote_storage(self):
+        """
+        Tests that storage deltas of remote clients are applied
+        """
+        storage = self.subscriber.get_remote_storage(
+            ON_OPEN, 'id', {'changed': {'a': 1, 'b': 2}, 'removed': []})
+        self.assertEqual({'a': 1, 'b': 2}, storage)
+
+        storage = self.subscriber.get_remote_storage(ON_RECEIVE, 'id', None)
+        self.assertEqual({'a': 1, 'b': 2}, storage)
+
+        storage = self.subscriber.get_remote_storage(
+            ON_RECEIVE, 'id', {'changed': {'a': 3}, 'removed': ['b']})
+        self.assertEqual({'a': 3}, storage)
+
+        self.subscriber.get_remote_storage(ON_CLOSE, 'id', None)
+        self.assertNotIn('id', self.subscriber.storages)
+
+    def test_remote_storages_size(self):
+        """
+        Tests that storage of least recently active remote clients is forgotten
+        """
+        self.subscriber.storages_size = 2
+
+        for client_id in ('a', 'b', 'a', 'c'):
+            self.subscriber.get_remote_storage(
+                ON_RECEIVE, client_id, {'changed': {'id': client_id}, 'removed': []})
+
+        self.assertEqual(['a', 'c'], list(self.subscriber.storages))
+
+
+class RoutingFactory(object):
+    def __init__(self, mease, local_dispatch=False):
+        self.mease = mease
+        self.local_dispatch = local_dispatch
+
+
+@unittest.skipIf(redis is None, "requires redis")
+class RedisRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mease = Mease(TestBackend)
+        self.mease.sender(lambda routing, message: None, routing='chat')
+
+        settings = {'host': 'localhost', 'port': 6379, 'password': None,
+                    'channel': 'mease', 'routed': True, 'node_id': 'a'}
+        self.publisher = RedisPublisher(**settings)
+        self.subscriber = RedisSubscriber(**settings)
+
+    def test_get_channel(self):
+        """
+        Tests channels of routed messages
+        """
+        kwargs = {'routing': 'chat', 'node': 'paris'}
+        self.assertEqual('mease:send:chat', self.publisher.get_channel(ON_SEND, kwargs))
+        self.assertEqual({'routing': 'chat', 'node': 'paris'}, kwargs)
+
+        kwargs = {'payload': 'Hello', '_node': 'b'}
+        self.assertEqual('mease:node:b', self.publisher.get_channel(ON_CLIENT_SEND, kwargs))
+        self.assertEqual({'payload': 'Hello'}, kwargs)
+
+        self.assertEqual(
+            'mease:send', self.publisher.get_channel(ON_CLIENT_SEND, {'_node': None}))
+        self.assertEqual('mease', self.publisher.get_channel(ON_RECEIVE, {}))
+
+        self.publisher.routed = False
+        kwargs = {'routing': 'chat', 'node': 'paris'}
+        self.assertEqual('mease', self.publisher.get_channel(ON_SEND, kwargs))
+        self.assertEqual({'routing': 'chat', 'node': 'paris'}, kwargs)
+
+    def test_get_subscriptions(self):
+        """
+        Tests channels subscribed by routed subscribers
+        """
+        self.subscriber.factory = RoutingFactory(self.mease)
+        self.assertEqual(
+            (['mease', 'mease:node:a', 'mease:send', 'mease:send:chat'], []),
+            self.subscriber.get_subscriptions())
+
+        self.subscriber.factory = RoutingFactory(self.mease, local_dispatch=True)
+        self.assertEqual(
+            (['mease:node:a', 'mease:send', 'mease:send:chat'], []),
+            self.subscriber.get_subscriptions())
+
+        self.mease.sender(lambda routing, message: None)
+        self.assertEqual(
+            (['mease:node:a', 'mease:send'], ['mease:send:*']),
+            self.subscriber.get_subscriptions())
+
+
+class AckChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class AckMessage(object):
+    def __init__(self, channel, delivery_tag):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.body = None
+
+
+@unittest.skipIf(kombu is None, "requires kombu")
+class RabbitMQAckTestCase(unittest.TestCase):
+
+    def get_subscriber(self, **kwargs):
+        subscriber = RabbitMQSubscriber(
+            broker_url='memory://', exchange_name='mease', **kwargs)
+        subscriber.handle_message = lambda body: None
+        return subscriber
+
+    def test_ack_batch(self):
+        """
+        Tests that messages are acknowledged in batches
+        """
+        subscriber = self.get_subscriber(ack_batch_size=3)
+        channel = AckChannel()
+
+        for tag in range(1, 8):
+            subscriber.on_message(AckMessage(channel, tag))
+
+        self.assertEqual([(3, True), (6, True)], channel.acks)
+        self.assertEqual(1, subscriber.unacked_count)
+
+        subscriber.ack()
+        self.assertEqual((7, True), channel.acks[-1])
+        self.assertIsNone(subscriber.unacked)
+
+    def test_prefetch_count(self):
+        """
+        Tests that batches are limited to the prefetch count
+        """
+        subscriber = self.get_subscriber(prefetch_count=2, ack_batch_size=100)
+        self.assertEqual(2, subscriber.ack_batch_size)
+
+        channel = AckChannel()
+        subscriber.on_message(AckMessage(channel, 1))
+        subscriber.on_message(AckMessage(channel, 2))
+        self.assertEqual([(2, True)], channel.acks)
+
+
+@unittest.skipIf(kombu is None, "requires kombu")
+class RabbitMQRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mease = Mease(TestBackend)
+        self.mease.sender(lambda routing, message: None, routing='chat')
+
+        settings = {'broker_url': 'memory://', 'exchange_name': 'mease',
+                    'routed': True, 'node_id': 'a'}
+        self.publisher = RabbitMQPublisher(**settings)
+        self.subscriber = RabbitMQSubscriber(**settings)
+
+    def test_get_routing_key(self):
+        """
+        Tests routing keys of routed messages
+        """
+        kwargs = {'routing': 'chat', 'node': 'paris'}
+        self.assertEqual('send.chat', self.publisher.get_routing_key(ON_SEND, kwargs))
+        self.assertEqual({'routing': 'chat', 'node': 'paris'}, kwargs)
+
+        self.assertEqual(
+            'node.b', self.publisher.get_routing_key(ON_CLIENT_SEND, {'_node': 'b'}))
+        self.assertEqual(
+            'send', self.publisher.get_routing_key(ON_CLIENT_SEND, {'_node': None}))
+        self.assertEqual('events', self.publisher.get_routing_key(ON_OPEN, {}))
+
+        self.publisher.routed = False
+        self.assertEqual('', self.publisher.get_routing_key(ON_SEND, {'routing': 'chat'}))
+
+    def test_disconnected(self):
+        """
+        Tests that messages are only raised as disconnected with reconnect
+        """
+        self.publisher.connect()
+        self.publisher.connection.release()
+
+        self.publisher.publish(ON_SEND, None, None, routing='chat')
+        self.assertEqual(1, self.publisher.dropped)
+
+        self.publisher.reconnect = True
+        self.assertRaises(
+            PublisherDisconnected, self.publisher.publish, ON_SEND, None, None,
+            routing='chat')
+
+    def test_get_routing_keys(self):
+        """
+        Tests routing keys bound by routed subscribers
+        """
+        self.subscriber.factory = RoutingFactory(self.mease)
+        self.assertEqual(
+            ['events', 'node.a', 'send', 'send.chat'], self.subscriber.get_routing_keys())
+
+        self.subscriber.factory = RoutingFactory(self.mease, local_dispatch=True)
+        self.assertEqual(['node.a', 'send', 'send.chat'], self.subscriber.get_routing_keys())
+
+
+class ThreadPoolExecutorTestCase(unittest.TestCase):
+
+    def test_submit(self):
+        """
+        Tests that submitted functions are run
+        """
+        results = []
+
+        executor = ThreadPoolExecutor(size=2)
+        executor.start()
+
+        for i in range(10):
+            executor.submit(results.append, i)
+
+        executor.stop()
+
+        self.assertEqual(list(range(10)), sorted(results))
+        self.assertEqual(10, executor.stats()['executed'])
+
+    def test_overflow(self):
+        """
+        Tests load shedding policies
+        """
+        results = []
+
+        executor = ThreadPoolExecutor(size=1, queue_size=2)
+        for i in range(3):
+            executor.submit(results.append, i)
+
+        executor.start()
+        executor.stop()
+
+        self.assertEqual([0, 1], results)
+        self.assertEqual(1, executor.stats()['dropped'])
+
+        results = []
+
+        executor = ThreadPoolExecutor(size=1, queue_size=2, overflow=SHED_OLDEST)
+        for i in range(3):
+            executor.submit(results.append, i)
+
+        executor.start()
+        executor.stop()
+
+        self.assertEqual([1, 2], results)
+
+
+class OrderedExecutorTestCase(unittest.TestCase):
+
+    def test_submit_to(self):
+        """
+        Tests that functions with the same key run in order
+        """
+        results = {}
+
+        def append(key, i):
+            results.setdefault(key, []).append(i)
+
+        executor = OrderedExecutor(lanes=4)
+        executor.start()
+
+        for i in range(50):
+            for key in ('a', 'b', 'c'):
+                executor.submit_to(key, append, key, i)
+
+        executor.stop()
+
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(list(range(50)), results[key])
+
+        self.assertEqual(150, executor.stats()['executed'])
+
+    def test_stop_in_reactor(self):
+        """
+        Tests that lanes are stopped without blocking the reactor thread
+        """
+        from . import executors
+
+        running = Event()
+        release = Event()
+
+        def wait():
+            running.set()
+            release.wait(1)
+
+        executor = OrderedExecutor(lanes=1)
+        executor.start()
+        executor.submit(wait)
+        running.wait(1)
+
+        joins = []
+        is_io_thread, defer = executors.isInIOThread, executors.deferToThread
+        executors.isInIOThread = lambda: True
+        executors.deferToThread = lambda func: joins.append(func) or DeferredList([])
+
+        try:
+            executor.stop()
+        finally:
+            executors.isInIOThread, executors.deferToThread = is_io_thread, defer
+
+        # The reactor keeps running while the lane finishes its queue
+        self.assertEqual(1, len(joins))
+        release.set()
+        joins[0]()
+
+        self.assertEqual([], executor.lanes[0].threads)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_render(self):
+        """
+        Tests Prometheus text rendering
+        """
+        metrics = MetricsRegistry(prefix='test_')
+
+        counter = metrics.counter('messages_total', "Messages", ['type'])
+        counter.inc(labels=('OPEN',))
+        counter.inc(2, labels=('OPEN',))
+
+        gauge = metrics.gauge('connections', "Connections")
+        gauge.set_function(lambda: 3)
+
+        histogram = metrics.histogram('seconds', "Duration", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        self.assertEqual(
+            '# HELP test_messages_total Messages\n'
+            '# TYPE test_messages_total counter\n'
+            'test_messages_total{type="OPEN"} 3\n'
+            '# HELP test_connections Connections\n'
+            '# TYPE test_connections gauge\n'
+            'test_connections 3\n'
+            '# HELP test_seconds Duration\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.1"} 1\n'
+            'test_seconds_bucket{le="1"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            'test_seconds_sum 5.55\n'
+            'test_seconds_count 3\n',
+            metrics.render())
+
+    def test_threads(self):
+        """
+        Tests that values updated by several threads are summed
+        """
+        metrics = MetricsRegistry()
+        counter = metrics.counter('messages_total', "Messages")
+        histogram = metrics.histogram('seconds', "Duration", buckets=(1,))
+
+        def update():
+            for _ in range(1000):
+                counter.inc()
+                histogram.observe(0.5)
+
+        threads = [Thread(target=update) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([('messages_total', (), (), 4000)], counter.samples())
+        self.assertIn(('seconds_count', (), (), 4000), histogram.samples())
+
+    def test_disabled(self):
+        """
+        Tests that disabled metrics aren't updated
+        """
+        mease = Mease(TestBackend, metrics=False)
+        mease.opener(lambda client, clients_list: None)
+        mease.call_openers('a', [])
+
+        self.assertEqual({}, mease.metrics.callback_latency.collect())
+
+
+class ProtocolTestCase(unittest.TestCase):
+
+    def test_lazy_storage(self):
+        """
+        Tests that client storage is only created when used
+        """
+        from .server import MeaseWebSocketServerProtocol
+        from .server import new_client_id
+
+        client = MeaseWebSocketServerProtocol()
+        self.assertIsNone(client._storage)
+        self.assertIsNone(client.get_storage_delta())
+
+        client.storage['a'] = 1
+        self.assertEqual(
+            {'changed': {'a': 1}, 'removed': []}, client.get_storage_delta())
+
+        del client.storage['a']
+        self.assertEqual({'changed': {}, 'removed': ['a']}, client.get_storage_delta())
+        self.assertIsNone(client._sent_storage)
+
+        self.assertNotEqual(new_client_id(), new_client_id())
+        self.assertEqual(new_client_id()[:16], new_client_id()[:16])
+        self.assertLess(len(new_client_id()), 24)
+
+
+def make_factory(mease, local_dispatch=False, storage_delta=False):
+    """
+    Returns a server factory without listening socket nor backend connection
+    """
+    from .server import MeaseWebSocketServerFactory
+
+    factory = MeaseWebSocketServerFactory.__new__(MeaseWebSocketServerFactory)
+    factory.local_dispatch = local_dispatch
+    factory.storage_delta = storage_delta
+
+    factory.storage = {}
+    factory.clients_list = set()
+    factory.clients = {}
+
+    factory.pending_calls = deque()
+    factory.pending_calls_lock = Lock()
+    factory.pending_calls_scheduled = False
+
+    factory.groups = {}
+    factory.client_groups = {}
+
+    factory.mease = mease
+    factory.directory_executor = InlineExecutor()
+    mease.factory = factory
+    mease.subscriber.factory = factory
+
+    return factory
+
+
+class StubReactor(object):
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, func, *args, **kwargs):
+        self.calls.append((func, args, kwargs))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for func, args, kwargs in calls:
+            func(*args, **kwargs)
+
+
+class FailingDirectory(MemoryDirectory):
+    def register(self, client_id, node_id):
+        raise ValueError
+
+
+class FactoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from . import server
+
+        self.server = server
+        self.reactor = server.reactor
+        server.reactor = StubReactor()
+
+        self.mease = Mease(TestBackend)
+        self.factory = make_factory(self.mease)
+        self.protocol_class = server.MeaseWebSocketServerProtocol
+
+    def tearDown(self):
+        self.server.reactor = self.reactor
+
+    def connect(self, client_id):
+        client = self.protocol_class()
+        client.factory = self.factory
+        client._client_id = client_id
+        client.state = client.STATE_OPEN
+
+        # Frames sent to the client
+        client.sent = []
+        client.sendMessage = client.sent.append
+        client.sendPreparedMessage = client.sent.append
+        return client
+
+    def test_get_client(self):
+        """
+        Tests that connected clients are found by id
+        """
+        a, b = self.connect('a'), self.connect('b')
+        self.factory.add_client(a)
+        self.factory.add_client(b)
+
+        self.assertIs(a, self.factory.get_client('a'))
+        self.assertIs(b, self.factory.get_client('b'))
+        self.assertIsNone(self.factory.get_client('c'))
+
+        self.factory.remove_client(a)
+        self.assertIsNone(self.factory.get_client('a'))
+        self.assertEqual(set([b]), self.factory.clients_list)
+
+    def test_local_dispatch(self):
+        """
+        Tests that events of connected clients are dispatched without the backend
+        """
+        mease = Mease(TestBackend, executor=InlineExecutor())
+        mease.publisher = RecordingPublisher()
+        self.factory = make_factory(mease, local_dispatch=True)
+
+        received = []
+        mease.receiver(lambda client, clients_list, message: received.append(
+            (client, message)))
+
+        client = self.connect('a')
+        self.factory.add_client(client)
+        client.publish(ON_RECEIVE, message='Hello')
+
+        self.assertEqual([(client, 'Hello')], received)
+        self.assertEqual([], mease.publisher.messages)
+
+    def test_broadcast(self):
+        """
+        Tests that a message is prepared once and sent to open clients
+        """
+        a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+        for client in (a, b, c):
+            self.factory.add_client(client)
+
+        c.state = c.STATE_CLOSED
+        self.factory.broadcast({'message': 'Hello'})
+        self.factory.broadcast('Bye', clients=[a])
+        self.server.reactor.run()
+
+        self.assertEqual(2, len(a.sent))
+        self.assertIs(a.sent[0], b.sent[0])
+        self.assertEqual([a.sent[0]], b.sent)
+        self.assertEqual([], c.sent)
+
+        output = self.mease.metrics.render()
+        self.assertIn('mease_frames_out_total 3\n', output)
+        self.assertIn('mease_bytes_out_total 43\n', output)
+
+    def test_directory(self):
+        """
+        Tests that clients are registered and directory errors are caught
+        """
+        self.mease.directory = MemoryDirectory()
+
+        client = self.connect('a')
+        self.factory.add_client(client)
+        self.assertEqual(self.mease.backend.node_id, self.mease.directory.lookup('a'))
+
+        self.factory.remove_client(client)
+        self.assertIsNone(self.mease.directory.lookup('a'))
+
+        self.mease.directory = FailingDirectory()
+        self.factory.add_client(self.connect('b'))
+        self.assertIsNotNone(self.factory.get_client('b'))
+
+    def test_send(self):
+        """
+        Tests that sends from other threads are batched and skip closed clients
+        """
+        a, b = self.connect('a'), self.connect('b')
+
+        a.send('Hello')
+        b.send({'message': 'World'})
+        a.send('Bye')
+        self.assertEqual(1, len(self.server.reactor.calls))
+
+        b.state = b.STATE_CLOSED
+        self.server.reactor.run()
+
+        self.assertEqual([b'Hello', b'Bye'], a.sent)
+        self.assertEqual([], b.sent)
+
+        a.send('Again')
+        self.assertEqual(1, len(self.server.reactor.calls))
+
+    def test_groups(self):
+        """
+        Tests that groups are updated in the reactor thread
+        """
+        a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+        self.factory.add_client(a)
+        self.factory.add_client(b)
+        self.factory.add_client(c)
+
+        a.join('room')
+        b.join('room')
+        b.join('other')
+        c.join('room')
+        self.assertEqual(set(), self.factory.get_group('room'))
+
+        # Client closed before the reactor runs the join
+        self.factory.remove_client(c)
+
+        self.server.reactor.run()
+        self.assertEqual(set([a, b]), self.factory.get_group('room'))
+        self.assertEqual(set(['room', 'other']), self.factory.client_groups['b'])
+        self.assertNotIn('c', self.factory.client_groups)
+
+        b.leave('other')
+        self.factory.remove_client(a)
+        self.server.reactor.run()
+
+        self.assertEqual(set([b]), self.factory.get_group('room'))
+        self.assertNotIn('other', self.factory.groups)
+        self.assertNotIn('a', self.factory.client_groups)
+
+
+@unittest.skipIf(fakeredis is None, "requires fakeredis")
+class RedisDirectoryTestCase(unittest.TestCase):
+
+    def test_remove_stopped_nodes(self):
+        """
+        Tests that clients of stopped nodes are removed by running nodes
+        """
+        client = fakeredis.FakeStrictRedis()
+        directory = RedisDirectory(client, 'mease:clients')
+
+        directory.heartbeat('a')
+        directory.heartbeat('b')
+        directory.register(1, 'a')
+        directory.register(2, 'b')
+        directory.register(3, 'b')
+        directory.unregister(3, 'b')
+
+        # Node b stops
+        client.delete(directory.get_node_key('b'))
+        directory.heartbeat('a')
+
+        self.assertEqual('a', directory.lookup(1))
+        self.assertEqual({b'1': b'a'}, client.hgetall('mease:clients'))
+        self.assertEqual(set([b'a']), client.smembers(directory.get_nodes_key()))
+        self.assertFalse(client.exists(directory.get_clients_key('b')))
+
+
+@unittest.skipIf(fakeredis is None, "requires fakeredis")
+class RedisBatchingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+        self.pubsub = fakeredis.FakeStrictRedis(server=self.server).pubsub(
+            ignore_subscribe_messages=True)
+        self.pubsub.subscribe('mease')
+
+    def get_publisher(self, **kwargs):
+        publisher = RedisPublisher(
+            host='localhost', port=6379, password=None, channel='mease', **kwargs)
+        publisher.connect()
+        publisher.client = fakeredis.FakeStrictRedis(server=self.server)
+        return publisher
+
+    def get_messages(self, count):
+        messages = []
+        deadline = time.time() + 1
+
+        while len(messages) < count and time.time() < deadline:
+            message = self.pubsub.get_message(timeout=0.1)
+            if message is not None:
+                messages.append(message)
+
+        return [Envelope().unpack(message['data'])[4]['i'] for message in messages]
+
+    def test_batch_order(self):
+        """
+        Tests that batched messages are published in order, on exit for the last ones
+        """
+        publisher = self.get_publisher(batch_size=3, batch_interval=60000)
+
+        for i in range(3):
+            publisher.publish(ON_SEND, None, None, routing='mease.test', i=i)
+
+        self.assertEqual([0, 1, 2], self.get_messages(3))
+
+        publisher.publish(ON_SEND, None, None, routing='mease.test', i=3)
+        publisher.publish(ON_SEND, None, None, routing='mease.test', i=4)
+
+        publisher.exit()
+        self.assertEqual([3, 4], self.get_messages(2))
+
+    def test_batch_interval(self):
+        """
+        Tests that incomplete batches are published after the batch interval
+        """
+        publisher = self.get_publisher(batch_size=100, batch_interval=10)
+
+        publisher.publish(ON_SEND, None, None, routing='mease.test', i=0)
+        publisher.publish(ON_SEND, None, None, routing='mease.test', i=1)
+
+        self.assertEqual([0, 1], self.get_messages(2))
+        publisher.exit()
+
+
+class FlakyStreamClient(object):
+    def __init__(self, client, errors):
+        self.client = client
+        self.errors = list(errors)
+
+    def xread(self, *args, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.client.xread(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@unittest.skipIf(fakeredis is None, "requires fakeredis")
+class RedisStreamsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+
+        settings = {'host': 'localhost', 'port': 6379, 'password': None,
+                    'channel': 'mease:stream', 'node_id': 'a'}
+        self.publisher = RedisStreamsPublisher(**settings)
+        self.publisher.client = self.client
+
+        self.subscriber = RedisStreamsSubscriber(block=None, **settings)
+        self.subscriber.client = self.client
+        self.subscriber.last_id = '0-0'
+
+        self.messages = []
+        self.subscriber.handle_message = self.handle_message
+
+    def handle_message(self, message):
+        message = self.subscriber.unpack(message)
+        if message[1] == 'poison':
+            raise ValueError
+        self.messages.append(message)
+
+    def test_read(self):
+        """
+        Tests that published messages are read in order
+        """
+        self.publisher.publish(ON_RECEIVE, 'a', None, message='Hello')
+        self.publisher.publish(ON_CLOSE, 'a', None)
+
+        self.subscriber.read()
+        self.assertEqual([
+            (ON_RECEIVE, 'a', None, (), {'message': 'Hello'}),
+            (ON_CLOSE, 'a', None, (), {})
+        ], self.messages)
+
+        self.subscriber.read()
+        self.assertEqual(2, len(self.messages))
+
+    def test_cursor(self):
+        """
+        Tests that the last read id is only stored with a TTL
+        """
+        self.publisher.publish(ON_OPEN, 'a', None)
+        self.subscriber.read()
+        self.assertFalse(self.client.exists(self.subscriber.get_cursor_key()))
+
+        self.subscriber.cursor_ttl = 60
+        self.publisher.publish(ON_CLOSE, 'a', None)
+        self.subscriber.read()
+
+        key = self.subscriber.get_cursor_key()
+        self.assertEqual(self.subscriber.last_id, self.client.get(key))
+        self.assertTrue(0 < self.client.ttl(key) <= 60)
+
+    def test_listen_errors(self):
+        """
+        Tests that the listening thread survives Redis and message errors
+        """
+        from .backends import redis as redis_backend
+
+        sleep = redis_backend.sleep
+        redis_backend.sleep = lambda seconds: None
+
+        self.subscriber.client = FlakyStreamClient(
+            self.client, [redis.TimeoutError(), redis.ResponseError()])
+
+        self.publisher.publish(ON_OPEN, 'poison', None)
+        self.publisher.publish(ON_OPEN, 'a', None)
+
+        def handle_message(message):
+            self.handle_message(message)
+            if self.messages:
+                self.subscriber.closed = True
+
+        self.subscriber.handle_message = handle_message
+
+        try:
+            self.subscriber.listen()
+        finally:
+            redis_backend.sleep = sleep
+
+        self.assertEqual([(ON_OPEN, 'a', None, (), {})], self.messages)
+
+
+class WorkersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.main = sys.modules['__main__']
+        self.argv = sys.argv
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        sys.modules['__main__'] = self.main
+        sys.argv = self.argv
+
+    def test_worker_environment(self):
+        """
+        Tests that workers read their index and socket from the environment
+        """
+        os.environ.pop(WORKER_ENV, None)
+        os.environ.pop(WORKER_SOCKET_ENV, None)
+        self.assertEqual(0, get_worker_index())
+        self.assertIsNone(get_worker_socket())
+
+        os.environ[WORKER_ENV] = '3'
+        os.environ[WORKER_SOCKET_ENV] = '7,2'
+        self.assertEqual(3, get_worker_index())
+        self.assertEqual((7, 2), get_worker_socket())
+
+    def test_listening_socket(self):
+        """
+        Tests that the listening socket is bound and non-blocking
+        """
+        sock = listening_socket('127.0.0.1', 0)
+        try:
+            self.assertNotEqual(0, sock.getsockname()[1])
+            self.assertEqual(0, sock.gettimeout())
+        finally:
+            sock.close()
+
+    def test_worker_command(self):
+        """
+        Tests that workers run the script, or the module started with -m
+        """
+        sys.argv = ['server.py', '--debug']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        self.assertEqual(
+            [sys.executable, 'server.py', '--debug'], get_worker_command())
+
+        if sys.version_info >= (3, 4):
+            main = types.ModuleType('__main__')
+            main.__spec__ = types.SimpleNamespace(name='app.server')
+            sys.modules['__main__'] = main
+
+            self.assertEqual(
+                [sys.executable, '-m', 'app.server', '--debug'], get_worker_command())
+
+
+class MessageTracerTestCase(unittest.TestCase):
+
+    def test_sample(self):
+        """
+        Tests that one message out of `rate` is logged when DEBUG is disabled
+        """
+        self.assertIsNone(MessageTracer().sample())
+
+        tracer = MessageTracer(rate=3)
+        samples = [tracer.sample() for _ in range(9)]
+
+        self.assertEqual(3, len([log for log in samples if log is not None]))
+        self.assertIsNotNone(samples[2])
+
+
+class RESPTestCase(unittest.TestCase):
+
+    def test_encode_command(self):
+        """
+        Tests encoding commands
+        """
+        self.assertEqual(
+            b'*2\r\n$9\r\nSUBSCRIBE\r\n$5\r\nmease\r\n',
+            encode_command('SUBSCRIBE', 'mease'))
+
+    def test_parse_replies(self):
+        """
+        Tests parsing complete and incomplete replies
+        """
+        data = (
+            b'+OK\r\n'
+            b'*3\r\n$9\r\nsubscribe\r\n$5\r\nmease\r\n:1\r\n'
+            b'*3\r\n$7\r\nmessage\r\n$5\r\nmease\r\n$4\r\na\r\nb\r\n'
+            b'-ERR wrong\r\n'
+            b'*3\r\n$7\r\nmessage\r\n$5\r\nme')
+
+        replies, remaining = parse_replies(data)
+
+        self.assertEqual(b'OK', replies[0])
+        self.assertEqual([b'subscribe', b'mease', 1], replies[1])
+        self.assertEqual([b'message', b'mease', b'a\r\nb'], replies[2])
+        self.assertIsInstance(replies[3], RedisError)
+        self.assertEqual(4, len(replies))
+
+        replies, remaining = parse_replies(remaining + b'ase\r\n$-1\r\n')
+        self.assertEqual([[b'message', b'mease', None]], replies)
+        self.assertEqual(b'', remaining)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import logging
+from itertools import count
+
+from . import logger
+
+__all__ = ('MessageTracer',)
+
+trace_logger = logging.getLogger('mease.trace')
+
+
+class MessageTracer(object):
+    """
+    Decides if a message is logged on the hot path
+    Every message is logged when DEBUG is enabled, otherwise one message out of
+    `rate` is logged on the `mease.trace` logger at INFO level (none if `rate` is 0)
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.counter = count(1)
+
+    def sample(self):
+        """
+        Returns the logging function to use for the next message, or None
+        Messages should only be formatted when a function is returned
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            return logger.debug
+
+        if self.rate and next(self.counter) % self.rate == 0:
+            return trace_logger.info
+
+        return None
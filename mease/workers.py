@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+
+from . import logger
+
+__all__ = (
+    'Supervisor', 'is_worker', 'get_worker_index', 'get_worker_socket',
+    'get_worker_command', 'listening_socket')
+
+WORKER_ENV = 'MEASE_WORKER'
+WORKER_SOCKET_ENV = 'MEASE_WORKER_SOCKET'
+
+
+def is_worker():
+    """
+    Returns True in a process started by the supervisor
+    """
+    return WORKER_ENV in os.environ
+
+
+def get_worker_index():
+    """
+    Returns the index of a worker process, or 0
+    """
+    return int(os.environ.get(WORKER_ENV, 0))
+
+
+def get_worker_socket():
+    """
+    Returns the file descriptor and family of the listening socket
+    shared by the supervisor, or None
+    """
+    value = os.environ.get(WORKER_SOCKET_ENV)
+
+    if not value:
+        return None
+
+    fileno, family = value.split(',')
+    return int(fileno), int(family)
+
+
+def get_worker_command():
+    """
+    Returns the command running the current script again
+    Scripts started with `python -m` are run as modules
+    """
+    spec = getattr(sys.modules.get('__main__'), '__spec__', None)
+
+    if spec is not None and spec.name:
+        return [sys.executable, '-m', spec.name] + sys.argv[1:]
+
+    return [sys.executable] + sys.argv
+
+
+def listening_socket(host, port, reuse_port=False, backlog=50):
+    """
+    Returns a listening TCP socket
+    """
+    family, socktype, proto, _, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("SO_REUSEPORT is not available on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+
+    return sock
+
+
+class Supervisor(object):
+    """
+    Starts `workers` websocket server processes and restarts them when they crash
+
+    Workers run the current script again. They either share a listening socket
+    opened by the supervisor, or open their own with SO_REUSEPORT
+    """
+    def __init__(self, host, port, workers, reuse_port=False, restart_delay=1):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.restart_delay = restart_delay
+
+        self.processes = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Runs workers until the supervisor is stopped
+        """
+        env = dict(os.environ)
+
+        if not self.reuse_port:
+            self.socket = listening_socket(self.host, self.port)
+
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(self.socket.fileno(), True)
+
+            env[WORKER_SOCKET_ENV] = '{fileno},{family}'.format(
+                fileno=self.socket.fileno(), family=int(self.socket.family))
+
+        self.env = env
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        logger.info("Supervisor started {workers} workers on {host}:{port}".format(
+            workers=self.workers, host=self.host, port=self.port))
+
+        while self.processes:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                continue
+
+            process = self.processes.pop(pid, None)
+            if process is None:
+                continue
+
+            if not self.stopping:
+                logger.warning("Worker {pid} exited with status {status}, restarting".format(
+                    pid=pid, status=status))
+
+                time.sleep(self.restart_delay)
+                self.spawn(process.worker_index)
+
+        logger.info("Supervisor stopped")
+
+    def spawn(self, index):
+        """
+        Starts a worker process
+        """
+        env = dict(self.env)
+        env[WORKER_ENV] = str(index)
+
+        process = subprocess.Popen(get_worker_command(), env=env, close_fds=False)
+        process.worker_index = index
+        self.processes[process.pid] = process
+
+    def stop(self, signum, frame):
+        """
+        Asks workers to shut down gracefully
+        """
+        self.stopping = True
+
+        for process in self.processes.values():
+            try:
+                process.send_signal(signal.SIGTERM)
+            except OSError:
+                pass